@@ -0,0 +1,198 @@
+# Custom modules
+import Tracking.NucleiTracking as NucleiTracking
+
+'''
+Accuracy of tracking against ground-truth tracks (synthetic or annotated).
+
+Both the ground truth and the tracking output are turned into detections:
+{frame: [(track, x, y, shape)]}, the shape being a radius or a ROI,
+and mothers: {daughter track: (mother track, first frame of the daughter)}.
+
+In each frame, a detection is matched to the nearest ground-truth nucleus
+that contains its centroid (one to one). Then:
+  - Detection precision and recall
+  - Link precision and recall: a link joins two successive detections of a
+  track (across a gap if the track has blank lines). It is correct if both
+  detections match the same ground-truth track. Recall is over the links of
+  the ground truth (successive frames)
+  - Fragmentation: ground-truth tracks followed by more than one track
+  - Divisions: a detected division is correct if its mother matches the
+  true mother, and one of its daughters a true daughter, within FrameTolerance
+  - Split errors: unmatched detections whose centroid is in a (matched) true nucleus
+  - Merge errors: unmatched true nuclei whose centroid is in a matched detection
+'''
+
+SearchDistance = 50  # Largest distance (px) between a centroid and the nucleus that contains it
+FrameTolerance = 1   # Divisions detected 1 frame early or late are still correct
+
+class Point:
+    # Detection indexed in a NucleiTracking.Grid
+    __slots__ = ('x', 'y', 'Detection')
+
+    def __init__(self, Detection):
+        self.x = Detection[1]
+        self.y = Detection[2]
+        self.Detection = Detection
+
+def contains(Detection, x, y):
+    Shape = Detection[3]
+    if isinstance(Shape, (int, long, float)):
+        return (Detection[1] - x)**2 + (Detection[2] - y)**2 < Shape**2
+    return Shape.contains(int(x), int(y))
+
+## Conversion to detections
+def synthetic_tracks(Truth):
+    # Ground truth of Synthetic.movie()
+    Detections = {}
+    for Frame, Nuclei in enumerate(Truth['Frames']):
+        Detections[Frame + 1] = [(Id, x, y, Radius) for Id, x, y, Radius in Nuclei]
+    return Detections, dict(Truth['Mothers'])
+
+def cell_tracks(myCells, Lineage=None):
+    '''
+    Detections of cells (from NucleiTracking.track, or annotated and loaded with Cells.load_cells)
+    Mothers are read from the cells, or from Lineage (a Lineage.LineageIndex) if given
+    '''
+    Detections = {}
+    Mothers = {}
+    FirstFrames = {}
+    for myCell in myCells:
+        for i, Roi in enumerate(myCell.Nuclei):
+            if Roi is None: # Blank line (gap in the track)
+                continue
+            Frame = int(float(myCell.Table[i]['Slice']))
+            x, y = Roi.getContourCentroid()
+            Detections.setdefault(Frame, []).append((myCell.name, x, y, Roi))
+            FirstFrames.setdefault(myCell.name, Frame)
+    for myCell in myCells:
+        if Lineage is not None:
+            Mother = Lineage.mother(myCell.name)
+        else:
+            Mother = myCell.mother
+        if Mother and myCell.name in FirstFrames:
+            Mothers[myCell.name] = (Mother, FirstFrames[myCell.name])
+    return Detections, Mothers
+
+## Matching
+def match_frame(Found, Truth):
+    '''
+    Match the detections of one frame to the true nuclei of this frame
+    Return {found index: true index}, split errors, merge errors
+    '''
+    TrueGrid = NucleiTracking.Grid([Point(Detection) for Detection in Truth], SearchDistance)
+    Pairs = []       # (squared distance, found index, true index) of each detection inside a true nucleus
+    Covered = []     # (found index, true index) of each true nucleus inside a detection
+    for i, Detection in enumerate(Found):
+        x, y = Detection[1], Detection[2]
+        for j, myPoint in TrueGrid.query_indexed(x, y, SearchDistance):
+            if contains(myPoint.Detection, x, y):
+                Pairs.append(((myPoint.x - x)**2 + (myPoint.y - y)**2, i, j))
+            if contains(Detection, myPoint.x, myPoint.y):
+                Covered.append((i, j))
+    # One to one, nearest first
+    Pairs.sort()
+    Matches = {}
+    Matched = set()
+    for Distance2, i, j in Pairs:
+        if i not in Matches and j not in Matched:
+            Matches[i] = j
+            Matched.add(j)
+    # Split: unmatched detection inside a true nucleus (matched to another detection)
+    Splits = len(set([i for Distance2, i, j in Pairs if i not in Matches]))
+    # Merge: unmatched true nucleus inside a matched detection
+    Merges = len(set([j for i, j in Covered if j not in Matched and i in Matches]))
+    return Matches, Splits, Merges
+
+def track_links(Detections):
+    # (track, frame, next frame) of each pair of successive detections of a track
+    Frames = {}
+    for Frame, FrameDetections in Detections.iteritems():
+        for Detection in FrameDetections:
+            Frames.setdefault(Detection[0], []).append(Frame)
+    Links = []
+    for Track, TrackFrames in Frames.iteritems():
+        TrackFrames.sort()
+        Links.extend([(Track, TrackFrames[k], TrackFrames[k + 1]) for k in range(len(TrackFrames) - 1)])
+    return Links
+
+def ratio(a, b):
+    if b == 0:
+        return 1.0
+    return float(a)/b
+
+def f1(TP, nFound, nTrue):
+    if nFound + nTrue == 0:
+        return 1.0
+    return 2.0*TP/(nFound + nTrue)
+
+def evaluate(Found, FoundMothers, Truth, TrueMothers):
+    '''
+    Accuracy of the tracks Found against the tracks Truth (both as returned by
+    synthetic_tracks or cell_tracks). Return a dict of metrics
+    '''
+    # True track of each matched detection: (found track, frame) -> true track
+    TrueTrack = {}
+    Splits = Merges = nFound = nTrue = 0
+    for Frame in sorted(set(Found.keys()) | set(Truth.keys())):
+        FoundFrame = Found.get(Frame, [])
+        TrueFrame = Truth.get(Frame, [])
+        Matches, FrameSplits, FrameMerges = match_frame(FoundFrame, TrueFrame)
+        for i, j in Matches.iteritems():
+            TrueTrack[(FoundFrame[i][0], Frame)] = TrueFrame[j][0]
+        Splits += FrameSplits
+        Merges += FrameMerges
+        nFound += len(FoundFrame)
+        nTrue += len(TrueFrame)
+    # Links
+    FoundLinks = track_links(Found)
+    TrueLinks = track_links(Truth)
+    Correct = 0
+    for Track, Frame, nextFrame in FoundLinks:
+        Start = TrueTrack.get((Track, Frame))
+        if Start is not None and Start == TrueTrack.get((Track, nextFrame)):
+            Correct += 1
+    # Fragmentation: found tracks following each true track
+    Fragments = {}
+    for (Track, Frame), TrueId in TrueTrack.iteritems():
+        Fragments.setdefault(TrueId, set()).add(Track)
+    # Divisions: (mother, first frame of the daughters) -> daughters
+    TrueDivisions = {}
+    for Daughter, (Mother, Frame) in TrueMothers.iteritems():
+        TrueDivisions.setdefault((Mother, Frame), set()).add(Daughter)
+    TrueFirst = dict((Daughter, Frame) for Daughter, (Mother, Frame) in TrueMothers.iteritems())
+    FoundDivisions = {}
+    for Daughter, (Mother, Frame) in FoundMothers.iteritems():
+        FoundDivisions.setdefault((Mother, Frame), []).append(Daughter)
+    # Last frame of each found track, to find which true track the mother was
+    LastFrames = {}
+    for Track, Frame in TrueTrack.iterkeys():
+        LastFrames[Track] = max(Frame, LastFrames.get(Track, Frame))
+    DetectedDivisions = set()
+    for (Mother, Frame), Daughters in FoundDivisions.iteritems():
+        TrueMother = TrueTrack.get((Mother, LastFrames.get(Mother)))
+        for Daughter in Daughters:
+            TrueDaughter = TrueTrack.get((Daughter, Frame))
+            if TrueDaughter in TrueFirst and TrueMothers[TrueDaughter][0] == TrueMother \
+                    and abs(TrueFirst[TrueDaughter] - Frame) <= FrameTolerance:
+                DetectedDivisions.add((TrueMother, TrueFirst[TrueDaughter]))
+                break
+    TP = len(DetectedDivisions)
+    return {
+            'Detection precision': ratio(len(TrueTrack), nFound),
+            'Detection recall': ratio(len(TrueTrack), nTrue),
+            'Link precision': ratio(Correct, len(FoundLinks)),
+            'Link recall': ratio(Correct, len(TrueLinks)),
+            'Fragmented tracks': len([Tracks for Tracks in Fragments.values() if len(Tracks) > 1]),
+            'Fragments per track': ratio(sum([len(Tracks) for Tracks in Fragments.values()]), len(Fragments)),
+            'Division precision': ratio(TP, len(FoundDivisions)),
+            'Division recall': ratio(TP, len(TrueDivisions)),
+            'Division F1': f1(TP, len(FoundDivisions), len(TrueDivisions)),
+            'Split errors': Splits,
+            'Merge errors': Merges,
+            }
+
+def evaluate_cells(myCells, Truth):
+    # Accuracy of the output of NucleiTracking.track on a Synthetic.movie()
+    Found, FoundMothers = cell_tracks(myCells)
+    TrueDetections, TrueMothers = synthetic_tracks(Truth)
+    return evaluate(Found, FoundMothers, TrueDetections, TrueMothers)
@@ -0,0 +1,142 @@
+# Python modules
+import heapq
+
+'''
+Sparse linear assignment with birth and death:
+  - Rows (nodes of frame n) can be linked to columns (nodes of frame n+1)
+  through a sparse set of edges with a cost
+  - Any row can instead 'die' (DeathCost) and any column be 'born' (BirthCost)
+  - The set of links with the lowest total cost is returned
+
+Rows and columns are first grouped into connected components of the edge
+graph: since birth and death are always possible, each component can be
+solved on its own. Each component is solved as a min-cost flow over its
+edges only, so the work grows with the number of edges, not rows x columns.
+'''
+
+def components(Edges):
+    # Group rows and columns linked by edges (union-find)
+    Parent = {}
+    def find(x):
+        while Parent[x] != x:
+            Parent[x] = Parent[Parent[x]]
+            x = Parent[x]
+        return x
+    for i, j in Edges:
+        a, b = ('r', i), ('c', j)
+        Parent.setdefault(a, a)
+        Parent.setdefault(b, b)
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            Parent[ra] = rb
+    Groups = {}
+    for x in Parent:
+        Rows, Cols = Groups.setdefault(find(x), ([], []))
+        if x[0] == 'r':
+            Rows.append(x[1])
+        else:
+            Cols.append(x[1])
+    return [(sorted(Rows), sorted(Cols)) for Rows, Cols in Groups.values()]
+
+def solve_component(Rows, Cols, Adjacency, Edges, DeathCost, BirthCost):
+    '''
+    Min-cost flow over the edges of one component, by successive shortest paths:
+      - Linking row i to column j saves a death and a birth, so the cost of
+      its edge is Edges[(i, j)] - DeathCost - BirthCost
+      - Each shortest path from a free row to a free column (through edges
+      and links already made) is found by Dijkstra on reduced costs, with
+      potentials as in Jonker-Volgenant, and only the edges are visited
+      - Paths are added while they lower the total cost
+    Return the list of (row, col) links
+    '''
+    Gain = DeathCost + BirthCost
+    Infinity = float('inf')
+    # Potentials keep the reduced cost of every edge non-negative
+    RowPotential = dict((i, 0.0) for i in Rows)
+    ColPotential = dict((j, 0.0) for j in Cols)
+    for i in Rows:
+        for j, Cost in Adjacency[i]:
+            ColPotential[j] = min(ColPotential[j], Cost - Gain)
+    SinkPotential = min(ColPotential.values())
+    RowMatch = {}
+    ColMatch = {}
+    while True:
+        # Dijkstra from all free rows, until the nearest free column is reached
+        RowDist = {}
+        ColDist = {}
+        ColBest = {}
+        ColFrom = {}
+        Heap = [(-RowPotential[i], 0, i) for i in Rows if i not in RowMatch]
+        heapq.heapify(Heap)
+        SinkDist = Infinity
+        SinkCol = None
+        while Heap:
+            Dist, IsCol, x = heapq.heappop(Heap)
+            if Dist >= SinkDist:
+                break
+            if not IsCol:
+                if x in RowDist:
+                    continue
+                RowDist[x] = Dist
+                for j, Cost in Adjacency[x]:
+                    if j in ColDist or RowMatch.get(x) == j:
+                        continue
+                    NewDist = Dist + Cost - Gain + RowPotential[x] - ColPotential[j]
+                    if NewDist < ColBest.get(j, Infinity):
+                        ColBest[j] = NewDist
+                        ColFrom[j] = x
+                        heapq.heappush(Heap, (NewDist, 1, j))
+            else:
+                if x in ColDist:
+                    continue
+                ColDist[x] = Dist
+                i = ColMatch.get(x)
+                if i is None:
+                    # Free column: path to the sink
+                    NewDist = Dist + ColPotential[x] - SinkPotential
+                    if NewDist < SinkDist:
+                        SinkDist = NewDist
+                        SinkCol = x
+                elif i not in RowDist:
+                    # Back along the link of the column
+                    NewDist = Dist - (Edges[(i, x)] - Gain) + ColPotential[x] - RowPotential[i]
+                    heapq.heappush(Heap, (NewDist, 0, i))
+        # Stop once no path lowers the total cost
+        if SinkCol is None or SinkDist + SinkPotential >= 0:
+            break
+        for i in Rows:
+            RowPotential[i] += min(RowDist.get(i, SinkDist), SinkDist)
+        for j in Cols:
+            ColPotential[j] += min(ColDist.get(j, SinkDist), SinkDist)
+        SinkPotential += SinkDist
+        # Flip the links along the path
+        j = SinkCol
+        while j is not None:
+            i = ColFrom[j]
+            prevCol = RowMatch.get(i)
+            RowMatch[i] = j
+            ColMatch[j] = i
+            j = prevCol
+    return sorted(RowMatch.items())
+
+def sparse_assignment(Edges, DeathCost, BirthCost):
+    '''
+    Edges: {(row, col): cost}
+    Return the list of (row, col) links, sorted by row
+    Rows and columns that are not linked are deaths and births
+    '''
+    Adjacency = {}
+    for (i, j), Cost in Edges.iteritems():
+        Adjacency.setdefault(i, []).append((j, Cost))
+    for i in Adjacency:
+        Adjacency[i].sort()
+    Links = []
+    for Rows, Cols in components(Edges):
+        if len(Rows) == 1 and len(Cols) == 1:
+            # Single edge: link if cheaper than a death and a birth
+            if Edges[(Rows[0], Cols[0])] < DeathCost + BirthCost:
+                Links.append((Rows[0], Cols[0]))
+        else:
+            Links.extend(solve_component(Rows, Cols, Adjacency, Edges, DeathCost, BirthCost))
+    Links.sort()
+    return Links
@@ -0,0 +1,194 @@
+# Fiji modules
+from ij import IJ
+
+# Python modules
+import json
+import os
+import time
+
+# Custom modules
+import Tracking.NucleiTracking as NucleiTracking
+import Tracking.Segment as Segment
+import Tracking.Synthetic as Synthetic
+import Tracking.Metrics as Metrics
+import Tracking.Parallel as Parallel
+import Tracking.Accuracy as Accuracy
+import Tracking.Cells as Cells
+
+'''
+Tools to compare the speed and results of the tracking engines and of the
+measurement engines, and to time the whole pipeline on synthetic movies (see Synthetic.py)
+'''
+
+def node_key(myNode):
+    # Nodes are rebuilt by each run: identify them by frame and centroid
+    return (myNode.Frame, round(myNode.x, 1), round(myNode.y, 1))
+
+def link_set(SeedNodes):
+    # All (node, next node) links followed from the seed nodes
+    Links = set()
+    for Seed in SeedNodes:
+        CurrentNode = Seed
+        while CurrentNode.BestNext:
+            Links.add((node_key(CurrentNode), node_key(CurrentNode.BestNext)))
+            CurrentNode = CurrentNode.BestNext
+    return Links
+
+def run_linking(RoiPerFrames, TrackParam, imp, Linking):
+    Param = dict(TrackParam)
+    Param['Linking'] = Linking
+    NodesPerFrame = NucleiTracking.roi_to_nodes(RoiPerFrames, Param, imp)
+    start = time.time()
+    SeedNodes = NucleiTracking.find_best_matches(NodesPerFrame, Param, imp)
+    end = time.time()
+    return link_set(SeedNodes), end - start
+
+def compare_linking(RoiPerFrames, TrackParam, imp, Engines=('Gale-Shapley', 'Global assignment')):
+    '''
+    Link the same ROIs with two linking engines
+    Return the runtime of each engine (s) and the agreement between their links
+    (number of common links / number of links found by either engine)
+    '''
+    Report = {}
+    LinkSets = []
+    for Engine in Engines:
+        Links, Runtime = run_linking(RoiPerFrames, TrackParam, imp, Engine)
+        Report[Engine + ' time'] = Runtime
+        Report[Engine + ' links'] = len(Links)
+        LinkSets.append(Links)
+        IJ.log(Engine + ": " + str(len(Links)) + " links in " + str(round(Runtime, 2)) + " s")
+    Common = LinkSets[0] & LinkSets[1]
+    Either = LinkSets[0] | LinkSets[1]
+    if Either:
+        Report['Agreement'] = float(len(Common))/len(Either)
+    else:
+        Report['Agreement'] = 1.0
+    IJ.log("Agreement: " + str(round(100*Report['Agreement'], 1)) + "% of links")
+    return Report
+
+def compare_measurements(myCells, Channels, Keys, Type):
+    '''
+    Measure the same cells cell by cell (Cell.measure_channel) then frame by frame
+    (Cells.measure_cells), in Channels: [(channel name, ImagePlus)]
+    Return the runtime of each (s) and the largest difference between their values
+    '''
+    Report = {}
+    start = time.time()
+    for ChannelName, imp in Channels:
+        for myCell in myCells:
+            myCell.measure_channel(imp, ChannelName, Keys, Type)
+    Report['Cell by cell time'] = time.time() - start
+    Tables = [[dict(Row) for Row in myCell.Table] for myCell in myCells]
+    start = time.time()
+    Cells.measure_cells(myCells, Channels, Keys, Type)
+    Report['Frame by frame time'] = time.time() - start
+    Difference = 0.0
+    for myCell, Table in zip(myCells, Tables):
+        for Row, Measured in zip(myCell.Table, Table):
+            for Field, Value in Measured.items():
+                # NaN (e.g. kurtosis of a uniform ROI) differs from itself
+                if isinstance(Value, float) and Value == Value:
+                    Difference = max(Difference, abs(Row[Field] - Value))
+    Report['Largest difference'] = Difference
+    IJ.log("Cell by cell: %.2f s, frame by frame: %.2f s, largest difference %g" % (
+        Report['Cell by cell time'], Report['Frame by frame time'], Difference))
+    return Report
+
+## Pipeline benchmark on synthetic movies
+# (nuclei per frame, frames[, segmentation]) of each movie of the default benchmark
+# Segmentation: 'Threshold' (default) or 'Watershed' (marker controlled, see Segment.w_segment)
+# Movies are drawn when read, but segmentation copies them: thresholding keeps one
+# 16-bit copy (1.4 GB for the largest scales), the watershed three (1 GB for 500x50).
+# Give Fiji at least 3 GB of heap (Edit > Options > Memory & Threads)
+Scales = [(100, 50), (500, 100), (2000, 50), (100, 1000), (1000, 100), (500, 50, 'Watershed')]
+
+def synthetic_track_param(Radius=18, nThreads=None):
+    # Tracking parameters of the Track Nuclei dialog, scaled to the synthetic nuclei
+    if nThreads is None:
+        nThreads = Parallel.default_threads()
+    return {'Max Distance': 5*Radius, 'Watershed sigma': 5, 'Watershed input': 'External gradient',
+            'BackupDistance': True, 'Threads': nThreads}
+
+def benchmark_scale(nNuclei, nFrames, TrackParam, Label='', Seed=0, MovieParam={}, Segmentation='Threshold'):
+    '''
+    Segment and track a synthetic movie of nNuclei (at first) over nFrames
+    Segmentation: 'Threshold' or 'Watershed'
+    Return the report of the run: scale, time of each stage, tracking counts (see Metrics.py)
+    and accuracy against the true tracks of the movie (see Accuracy.py)
+    '''
+    Radius = MovieParam.get('Radius', 18)
+    IJ.log("Benchmark: " + str(nNuclei) + " nuclei, " + str(nFrames) + " frames, " + Segmentation)
+    imp, Truth = Synthetic.movie(nNuclei, nFrames, Seed=Seed, **MovieParam)
+    if Segmentation == 'Watershed':
+        Method = Synthetic.watershed_method(Radius)
+    else:
+        Method = Synthetic.segmentation_method(Radius)
+    Metrics.start(Label)
+    RoiPerFrames, StatsPerFrames = Segment.segment(imp, Method, nThreads=TrackParam.get('Threads'))
+    myCells = NucleiTracking.track(RoiPerFrames, TrackParam, imp, 0, StatsPerFrames)
+    Report = Metrics.stop().report()
+    Report.update({'Label': Label, 'Nuclei': nNuclei, 'Frames': nFrames, 'Seed': Seed, 'Segmentation': Segmentation,
+        'Width': imp.getWidth(), 'Height': imp.getHeight(), 'Tracks': len(Truth['Mothers']) + nNuclei,
+        'Date': time.strftime('%Y-%m-%d %H:%M:%S')})
+    Report['Accuracy'] = Accuracy.evaluate_cells(myCells, Truth)
+    imp.flush()
+    return Report
+
+def save_report(Report, ReportPath):
+    # One JSON object per line, so that runs of several commits can share the same file
+    reportfile = open(ReportPath, 'a')
+    reportfile.write(json.dumps(Report, sort_keys=True) + '\n')
+    reportfile.close()
+
+def load_reports(ReportPath):
+    Reports = []
+    if os.path.isfile(ReportPath):
+        reportfile = open(ReportPath, 'r')
+        for Line in reportfile:
+            if Line.strip():
+                Reports.append(json.loads(Line))
+        reportfile.close()
+    return Reports
+
+def run_benchmark(ReportPath, Label='', Scales=Scales, TrackParam=None, Seed=0, MovieParam={}):
+    # Time each scale and append its report to ReportPath as soon as it is done
+    if TrackParam is None:
+        TrackParam = synthetic_track_param(MovieParam.get('Radius', 18))
+    Reports = []
+    for Scale in Scales:
+        Report = benchmark_scale(Scale[0], Scale[1], TrackParam, Label, Seed, MovieParam, *Scale[2:])
+        save_report(Report, ReportPath)
+        IJ.log(Metrics.summary(Report))
+        IJ.log(", ".join(["%s %.3g" % Item for Item in sorted(Report['Accuracy'].items())]))
+        Reports.append(Report)
+    return Reports
+
+def stage_times(Report):
+    Times = {}
+    for Stage in Report['Stages']:
+        Times[Stage['Stage']] = Times.get(Stage['Stage'], 0) + Stage['Time']
+    # Parts of stages (e.g. splits), compared as stages
+    Times.update(Report.get('Parts', {}))
+    return Times
+
+def compare_reports(ReportPath, Label1, Label2):
+    '''
+    Compare the runs labelled Label1 and Label2 in ReportPath, scale by scale (last run of each)
+    Return {(nuclei, frames, segmentation): {stage: time of Label2 / time of Label1}}
+    '''
+    Runs = {}
+    for Report in load_reports(ReportPath):
+        if Report['Label'] in (Label1, Label2):
+            Scale = (Report['Nuclei'], Report['Frames'], Report.get('Segmentation', 'Threshold'))
+            Runs[(Report['Label'],) + Scale] = stage_times(Report)
+    Ratios = {}
+    for Key, Times1 in sorted(Runs.items()):
+        Label, Scale = Key[0], Key[1:]
+        if Label != Label1 or (Label2,) + Scale not in Runs:
+            continue
+        Times2 = Runs[(Label2,) + Scale]
+        Ratios[Scale] = dict((Stage, Times2[Stage]/Times1[Stage])
+                for Stage in Times1.keys() if Stage in Times2 and Times1[Stage] > 0)
+        IJ.log("%d nuclei, %d frames, %s: " % Scale + ", ".join(
+            ["%s x%.2f" % (Stage, Ratio) for Stage, Ratio in sorted(Ratios[Scale].items())]))
+    return Ratios
@@ -6,6 +6,8 @@ from ij.gui import Roi, ShapeRoi, PointRoi
 from java.awt import Color as c
 
 import Results
+import Metrics
+import LabelImage
 import os
 import glob
 import math
@@ -29,6 +31,8 @@ class Cell:
         else:
             self.name = name
         self.Fields = ['Name', 'BaseName', 'Slice']
+        # Name of the mother cell, if born from a cytokinesis (see Lineage.py)
+        self.mother = None
 
     def __len__(self):
         return len(self.Nuclei)
@@ -95,6 +99,7 @@ class Cell:
         return occurences
 
     def getRoiAt(self, Slice):
+        # None if the cell has no nucleus at Slice, or a blank line (gap in the track)
         for i, Row in enumerate(self.Table):
             if int(float(Row['Slice'])) == Slice:
                 return self.Nuclei[i]
@@ -216,15 +221,21 @@ class Cell:
                 self.addField(BaseName + ' 99%')
 
     ### Measure cell ###
-    def measure_channel(self, imp, ChannelName, Keys, Type):
-        ip = imp.getProcessor()
+    def getCompartment(self, Type):
         if Type == 'Nucleus':
-            array = self.Nuclei
+            return self.Nuclei
         elif Type == 'Cytoplasm':
-            array = self.Cytoplasms
+            return self.Cytoplasms
         elif Type == 'Full Cell':
-            array = self.FullCells
+            return self.FullCells
+
+    def measure_channel(self, imp, ChannelName, Keys, Type):
+        # One ROI at a time: to measure many cells, measure_cells reads each frame once
+        ip = imp.getProcessor()
+        array = self.getCompartment(Type)
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Slice = self.Table[i]['Slice']
             imp.setPosition(int(Slice))
             ip.setRoi(Roi)
@@ -255,6 +266,9 @@ class Cell:
             return Donut
         self.Cytoplasms = [] #ensure array is empty
         for Nucleus in self.Nuclei:
+            if Nucleus is None: # Blank line (gap in the track)
+                self.Cytoplasms.append(None)
+                continue
             Slice = Nucleus.getPosition()
             Donut = getCytoplasmDonut(Nucleus)
             Donut.setPosition(Slice)
@@ -264,6 +278,9 @@ class Cell:
         # Substract nucleus from full cell to get cytoplasm
         self.Cytoplasms = [] #ensure array is empty
         for Nucleus, FullCell in zip(self.Nuclei, self.FullCells):
+            if Nucleus is None or FullCell is None: # Blank line (gap in the track)
+                self.Cytoplasms.append(None)
+                continue
             sNucleus = ShapeRoi(Nucleus)
             sFull = ShapeRoi(FullCell)
             Cytoplasm = sFull.not(sNucleus)
@@ -288,6 +305,8 @@ class Cell:
         ip = imp.getProcessor()
         array = self.Nuclei
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Slice = self.Table[i]['Slice']
             imp.setPosition(int(Slice))
             RectRoi = self.MakeRectangleRoi(Roi, width, height)
@@ -311,6 +330,8 @@ class Cell:
             array == self.FullCells
         FociInCell = []
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Frame = Roi.getPosition()
             CellName = self.Table[i]['BaseName']
             Foci = 0
@@ -388,6 +409,8 @@ class Cell:
             array = self.FullCells
         Index = RM.getCount()
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             if self.Table[i]['Phase'] == 'G1-S':
                 myColor = c.blue
@@ -434,6 +457,8 @@ class Cell:
             myColor = c.gray
         # Do colors
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             if not Excluded:
                 if self.Table[i]['Phase'] == 'G1-S':
@@ -487,6 +512,8 @@ class Cell:
             myColor = c.gray
         # Do colors
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             if not Excluded:
                 if self.Table[i]['Phase'] == 'G1-S':
@@ -523,6 +550,8 @@ class Cell:
             array = self.FullCells
         Index = RM.getCount()
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             Roi.setStrokeColor(myColor)
             RM.addRoi(Roi)
@@ -544,6 +573,8 @@ class Cell:
             array = self.FullCells
         Index = RM.getCount()
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             Roi.setStrokeColor(myColor)
             RM.addRoi(Roi)
@@ -565,6 +596,8 @@ class Cell:
             array = self.FullCells
         Index = RM.getCount()
         for i, Roi in enumerate(array):
+            if Roi is None: # Blank line (gap in the track)
+                continue
             Name = self.Table[i]['BaseName']
             Roi.setStrokeColor(myColor)
             RM.addRoi(Roi)
@@ -689,11 +722,22 @@ def load_cells(ResultsRoot, rm, resetRois=True):
     myCells = []
     prevName = None
     Index = 0
+    TableIndex = 0
     Table = Results.autoload_tsv(ResultsRoot)
     while Index < RoiCount:
         BaseName = DefaultRois[Index].getName()
         CellName = BaseName.split('_')[0]
-        SliceData = Table[Index]
+        # Rows with no ROI are blank lines (gaps in the track) of the current cell
+        while (CellName == prevName and TableIndex < len(Table)
+                and Table[TableIndex]['Name'] == CellName and Table[TableIndex]['BaseName'] != BaseName):
+            myCells[-1].addBlankLine(Table[TableIndex]['Slice'])
+            if CytoRois:
+                myCells[-1].Cytoplasms.append(None)
+            if FullCellRois:
+                myCells[-1].FullCells.append(None)
+            myCells[-1].editTable(Table[TableIndex])
+            TableIndex += 1
+        SliceData = Table[TableIndex]
         if CellName != prevName:
             myCells.append(Cell())
             if NucleiRois:
@@ -716,9 +760,78 @@ def load_cells(ResultsRoot, rm, resetRois=True):
         else:
             IJ.log(BaseName + ': Error loading cells from RM')
         Index += 1
+        TableIndex += 1
     return myCells
 
+## Measure all cells, frame by frame
+# Keys measured under label masks, the others (percentiles) need the pixels of each ROI
+SweepKeys = ['Mean', 'Median', 'Min', 'Max', 'StD', 'Kurtosis', 'Skewness', 'Area', 'Perimeter', 'Circularity', 'Centroid', 'Feret']
+
+def frame_rois(myCells, Type):
+    # {frame: [(cell, row index, ROI)]} of the Type compartment of the cells
+    Frames = {}
+    for myCell in myCells:
+        for i, Roi in enumerate(myCell.getCompartment(Type)):
+            if Roi is None: # Blank line (gap in the track)
+                continue
+            Frames.setdefault(int(float(myCell.Table[i]['Slice'])), []).append((myCell, i, Roi))
+    return Frames
+
+def sweep_keys(Keys):
+    # True if all Keys can be measured under label masks
+    return not [Key for Key in Keys if Key not in SweepKeys]
+
+def frame_labels(Entries, width, height, Type):
+    # Masks of the ROIs of one frame (Entries, from frame_rois), made once for all channels
+    # Nuclei don't overlap each other: a single label image
+    # Return [(index in Entries of each label, masks of the labels)]
+    Layers = LabelImage.label_layers([Roi for myCell, i, Roi in Entries], width, height, Type != 'Nucleus')
+    return [(Indices, LabelImage.label_masks(label_ip, BoundsList)) for label_ip, Indices, BoundsList in Layers]
+
+def frame_statistics(ip, Entries, Keys, Layers=None):
+    '''
+    Statistics in ip of the ROIs of one frame (Entries, from frame_rois), in the same order
+    Layers: masks of Entries (from frame_labels), made here if not given
+    Only reads ip and the ROIs: frames can be measured in parallel
+    '''
+    if not sweep_keys(Keys):
+        Stats = []
+        for myCell, i, Roi in Entries:
+            ip.setRoi(Roi)
+            Stats.append(ip.getStatistics())
+        return Stats
+    if Layers is None:
+        Layers = frame_labels(Entries, ip.getWidth(), ip.getHeight(), 'Full Cell')
+    Stats = [None]*len(Entries) # None: ROI out of the image
+    for Indices, Masks in Layers:
+        for Index, Stat in zip(Indices, LabelImage.label_statistics(ip, Masks)):
+            Stats[Index] = Stat
+    return Stats
+
+def add_frame_measurements(Entries, Stats, ChannelName, Keys, Type, ip=None):
+    # Write the statistics of frame_statistics in the tables of the cells, same columns as Cell.measure_channel
+    BaseName = ChannelName + ' ' + Type
+    for (myCell, i, Roi), Stat in zip(Entries, Stats):
+        if Stat is not None:
+            myCell.add_measurements(BaseName, i, Stat, Keys, Roi, ip)
+
+def measure_cells(myCells, Channels, Keys, Type):
+    '''
+    Same as measure_channel for each cell and channel
+    Channels: [(channel name, ImagePlus)], each frame of each stack is read once,
+    and the masks of a frame are made once for all channels
+    '''
+    for Frame, Entries in sorted(frame_rois(myCells, Type).items()):
+        Layers = None
+        for ChannelName, imp in Channels:
+            ip = imp.getStack().getProcessor(Frame)
+            if Layers is None and sweep_keys(Keys):
+                Layers = frame_labels(Entries, ip.getWidth(), ip.getHeight(), Type)
+            Stats = frame_statistics(ip, Entries, Keys, Layers)
+            add_frame_measurements(Entries, Stats, ChannelName, Keys, Type, ip)
+
 def save_cells(Cells, ResultsRoot=None, rm=None, SaveRois=False, SaveData=False, Prefix='', Type='Nuclei', color=''):
+    Start = Metrics.clock()
     if rm:
         rm.reset()
     FullTable = []
@@ -746,3 +859,4 @@ def save_cells(Cells, ResultsRoot=None, rm=None, SaveRois=False, SaveData=False,
         if SaveData:
             tsvpath = os.path.join(ResultsRoot, Prefix + '_Table.tsv')
             Results.write_tsv(FullTable, tsvpath, AllFields)
+    Metrics.stage('Saving', Start)
@@ -0,0 +1,111 @@
+# Fiji modules
+from ij.process import FHT, FloatProcessor, ImageProcessor
+from jarray import array
+
+# Other modules
+import math
+import os
+
+# Custom modules
+import Tracking.Parallel as Parallel
+import Tracking.Results as Results
+
+'''
+Stage drift between consecutive frames, estimated by phase correlation.
+
+The central square of each frame is binned to a CorrelationSize x CorrelationSize
+image (power of 2, for ImageJ's FHT), windowed, and its spectrum whitened.
+The inverse transform of the product of two whitened spectra peaks at the
+translation between the two frames (precision below one binned pixel).
+
+Drift of frame n: (dx, dy) such that a nucleus at (x, y) in frame n-1 is
+at (x + dx, y + dy) in frame n. The first frame has no drift (0, 0).
+'''
+
+CorrelationSize = 256
+
+def hann_window(Size):
+    # 2D Hann window, flattened (row by row)
+    Window1D = [0.5 - 0.5*math.cos(2*math.pi*(i + 0.5)/Size) for i in range(Size)]
+    return [wy*wx for wy in Window1D for wx in Window1D]
+
+def whitened_spectrum(ip, Size, Window):
+    '''
+    Hartley transform of the (binned, windowed) central square of ip,
+    divided by its amplitude so that only the phase is left
+    Return the FHT and the binning factor
+    '''
+    Side = min(ip.getWidth(), ip.getHeight())
+    ip.setRoi((ip.getWidth() - Side)/2, (ip.getHeight() - Side)/2, Side, Side)
+    Square = ip.crop().convertToFloat()
+    ip.resetRoi()
+    Square.setInterpolationMethod(ImageProcessor.BILINEAR)
+    Binned = Square.resize(Size, Size, True).getPixels()
+    Mean = sum(Binned)/len(Binned)
+    fht = FHT(FloatProcessor(Size, Size, array([(p - Mean)*w for p, w in zip(Binned, Window)], 'f'), None))
+    fht.setShowProgress(False)
+    fht.transform()
+    # Amplitude of frequency k from the Hartley values at k and -k
+    Pixels = fht.getPixels()
+    H = list(Pixels)
+    for r in xrange(Size):
+        rowMod = ((Size - r) % Size)*Size
+        for c in xrange(Size):
+            k = r*Size + c
+            m = rowMod + (Size - c) % Size
+            Amplitude = math.sqrt((H[k]*H[k] + H[m]*H[m])/2)
+            if Amplitude > 0:
+                Pixels[k] = H[k]/Amplitude
+    return fht, float(Side)/Size
+
+def peak_offset(Values, i):
+    # Sub-pixel position of a peak along one axis (parabola through 3 values)
+    Left, Center, Right = Values
+    Curvature = Left - 2*Center + Right
+    if Curvature >= 0:
+        return float(i)
+    return i + 0.5*(Left - Right)/Curvature
+
+def frame_shift(prevSpectrum, Spectrum):
+    '''
+    Translation (dx, dy) from the frame of prevSpectrum to the frame of Spectrum
+    (both from whitened_spectrum)
+    '''
+    prevFHT, Scale = prevSpectrum
+    fht, Scale = Spectrum
+    Correlation = fht.conjugateMultiply(prevFHT)
+    Correlation.setShowProgress(False)
+    Correlation.inverseTransform()
+    Correlation.swapQuadrants()
+    Pixels = Correlation.getPixels()
+    Size = Correlation.getWidth()
+    Peak = list(Pixels).index(max(Pixels))
+    py, px = divmod(Peak, Size)
+    # Neighbours of the peak (the correlation is periodic)
+    def value(x, y):
+        return Pixels[(y % Size)*Size + x % Size]
+    x = peak_offset((value(px - 1, py), value(px, py), value(px + 1, py)), px)
+    y = peak_offset((value(px, py - 1), value(px, py), value(px, py + 1)), py)
+    # Zero translation is at the center after swapQuadrants
+    return ((x - Size/2)*Scale, (y - Size/2)*Scale)
+
+def frame_drifts(imp, nThreads=None):
+    # Drift of each frame of imp (a list of (dx, dy), see above)
+    if nThreads is None:
+        nThreads = Parallel.default_threads()
+    Stack = imp.getStack()
+    Size = CorrelationSize
+    Window = hann_window(Size)
+    # Each frame gets its own processor, so frames can be transformed in parallel
+    Spectra = Parallel.run_tasks(whitened_spectrum,
+            [(Stack.getProcessor(Frame), Size, Window) for Frame in range(1, Stack.getSize() + 1)], nThreads)
+    Drifts = [(0.0, 0.0)]
+    Drifts.extend(Parallel.run_tasks(frame_shift,
+            [(Spectra[i - 1], Spectra[i]) for i in range(1, len(Spectra))], nThreads))
+    return Drifts
+
+def save_drifts(Drifts, ResultsRoot, Prefix='0'):
+    # One row per frame, next to the cells table
+    Fields = ['Frame', 'dX', 'dY']
+    Table = [{'Frame': i + 1, 'dX': dx, 'dY': dy} for i, (dx, dy) in enumerate(Drifts)]
+    Results.write_tsv(Table, os.path.join(ResultsRoot, Prefix + '_Drift.tsv'), Fields)
@@ -0,0 +1,147 @@
+# Fiji modules
+from ij.measure import Measurements
+from ij.process import ImageProcessor, ImageStatistics, ShortProcessor
+
+# Java modules
+from java.awt import Rectangle
+
+'''
+Label images: all ROIs of a frame are drawn once into a 16-bit image,
+where pixels of the i-th ROI have value (i + 1) and the background is 0.
+
+Frame-to-frame overlaps are then read from a single pass over two label
+images (only over the bounding boxes of the ROIs of one frame), instead of
+intersecting each pair of ROIs geometrically.
+Likewise, the label images of the ROIs of a frame are drawn once, and the
+mask of each ROI is cut from them once for all channels. Each channel is then
+measured by Java (ImageStatistics) under these masks, without reading the
+frame again for each ROI (imp.setPosition) or rasterizing each ROI again.
+'''
+
+def rasterize(RoiList, width, height, x0=0, y0=0):
+    # Draw ROI number i with value (i + 1), 0 being the background
+    # (x0, y0): position of the label image in the frame, to only draw a region of it
+    label_ip = ShortProcessor(width, height)
+    for i, Roi in enumerate(RoiList):
+        if x0 or y0:
+            Bounds = Roi.getBounds()
+            Roi = Roi.clone()
+            Roi.setLocation(Bounds.x - x0, Bounds.y - y0)
+        label_ip.setValue(i + 1)
+        label_ip.fill(Roi)
+    return label_ip
+
+def clipped_bounds(Bounds, width, height):
+    # (x0, x1, y0, y1) of a ROI bounding box, inside an image of size (width, height)
+    return (max(Bounds.x, 0), min(Bounds.x + Bounds.width, width),
+            max(Bounds.y, 0), min(Bounds.y + Bounds.height, height))
+
+def overlap_table(label_ip1, label_ip2, BoundsList=None):
+    '''
+    Joint histogram of two label images of the same size
+    BoundsList: bounding box of the ROI of each label of label_ip2 (in its coordinates),
+    only the pixels of each label inside its box are read, instead of the whole images
+    Return a sparse table {(label1, label2): overlap area (in pixels)}
+    Only pairs of (non-background) labels that overlap are listed
+    '''
+    Pixels1 = label_ip1.getPixels()
+    Pixels2 = label_ip2.getPixels()
+    Table = {}
+    if BoundsList is None:
+        for i in xrange(len(Pixels1)):
+            label1 = Pixels1[i]
+            if label1:
+                label2 = Pixels2[i]
+                if label2:
+                    # Java shorts are signed
+                    Pair = (label1 & 0xffff, label2 & 0xffff)
+                    Table[Pair] = Table.get(Pair, 0) + 1
+        return Table
+    width = label_ip2.getWidth()
+    height = label_ip2.getHeight()
+    for Index, Bounds in enumerate(BoundsList):
+        label2 = Index + 1
+        x0, x1, y0, y1 = clipped_bounds(Bounds, width, height)
+        Overlaps = {}
+        for y in xrange(y0, y1):
+            Row = y*width
+            for i in xrange(Row + x0, Row + x1):
+                # Pixels of the box covered by another ROI are counted with that ROI
+                if (Pixels2[i] & 0xffff) == label2:
+                    label1 = Pixels1[i]
+                    if label1:
+                        Overlaps[label1] = Overlaps.get(label1, 0) + 1
+        for label1, Area in Overlaps.iteritems():
+            Table[(label1 & 0xffff, label2)] = Area
+    return Table
+
+def label_layers(RoiList, width, height, Overlapping=True):
+    '''
+    Rasterize the ROIs of a frame, to measure them in every channel of that frame
+    ROIs that may overlap (e.g. cytoplasms of neighbour cells) are drawn in
+    several label images: each ROI goes to the first one with no other ROI in
+    its bounding box (tested on the box, without drawing the ROI)
+    With Overlapping=False (e.g. nuclei), all ROIs are drawn in a single label image
+    Return [(label image, [index in RoiList of each label], [bounding box of each label])]
+    '''
+    Layers = []
+    for Index, Roi in enumerate(RoiList):
+        Bounds = Roi.getBounds()
+        for label_ip, Indices, BoundsList in Layers:
+            if not Overlapping:
+                break
+            label_ip.setRoi(Bounds)
+            Free = ImageStatistics.getStatistics(label_ip, Measurements.MIN_MAX, None).max == 0
+            label_ip.resetRoi()
+            if Free:
+                break
+        else:
+            label_ip, Indices, BoundsList = ShortProcessor(width, height), [], []
+            Layers.append((label_ip, Indices, BoundsList))
+        Indices.append(Index)
+        BoundsList.append(Bounds)
+        label_ip.setValue(len(Indices))
+        label_ip.fill(Roi)
+    return Layers
+
+def label_masks(label_ip, BoundsList):
+    '''
+    Mask of each label of label_ip in its bounding box (clipped to the image),
+    cut from the label image and thresholded by Java, once for all channels
+    BoundsList: bounding box of each label (from label_layers)
+    Return [(box, mask)], index i for label (i + 1), None if the box is out of the image
+    '''
+    width = label_ip.getWidth()
+    height = label_ip.getHeight()
+    Masks = []
+    for Index, Bounds in enumerate(BoundsList):
+        x0, x1, y0, y1 = clipped_bounds(Bounds, width, height)
+        if x1 <= x0 or y1 <= y0:
+            Masks.append(None)
+            continue
+        Box = Rectangle(x0, y0, x1 - x0, y1 - y0)
+        label_ip.setRoi(Box)
+        Crop = label_ip.crop()
+        Crop.setThreshold(Index + 1, Index + 1, ImageProcessor.NO_LUT_UPDATE)
+        Masks.append((Box, Crop.createMask()))
+    label_ip.resetRoi()
+    return Masks
+
+def label_statistics(ip, Masks):
+    '''
+    Statistics of ip under each mask of label_masks, measured by Java as
+    ip.getStatistics() with the ROI set (same values, for any type of image)
+    Return a list of ImageStatistics, None if a label has no pixel
+    '''
+    Stats = []
+    for Mask in Masks:
+        if Mask is None:
+            Stats.append(None)
+            continue
+        Box, mask_ip = Mask
+        ip.setRoi(Box)
+        ip.setMask(mask_ip)
+        Stat = ip.getStatistics()
+        Stats.append(Stat if Stat.pixelCount else None)
+    ip.resetRoi()
+    return Stats
@@ -0,0 +1,95 @@
+# Other modules
+import os
+
+# Custom modules
+import Tracking.Results as Results
+
+'''
+Lineage of the tracked cells, from the cytokinesis found while tracking.
+
+The lineage table has one row per daughter cell: the mother cell, the daughter
+cell and the division frame (first frame of the daughters). It is saved as
+<Prefix>_Lineage.tsv, next to <Prefix>_Table.tsv.
+
+LineageIndex loads it as a tree, indexed by cell name:
+  - mother and daughters of a cell: O(1)
+  - ancestors of a cell: O(depth)
+  - whole family (all cells descending from the same ancestor): O(1)
+'''
+
+Fields = ['Mother', 'Daughter', 'Frame']
+
+def lineage_table(myCells):
+    # Rows of the lineage table, from the mother of each cell (set when tracking)
+    Table = []
+    for myCell in myCells:
+        if myCell.mother:
+            Table.append({'Mother': myCell.mother, 'Daughter': myCell.name,
+                'Frame': int(float(myCell.Table[0]['Slice']))})
+    return Table
+
+def lineage_path(ResultsRoot, Prefix='0'):
+    return os.path.join(ResultsRoot, Prefix + '_Lineage.tsv')
+
+def save_lineage(myCells, ResultsRoot, Prefix='0'):
+    Results.write_tsv(lineage_table(myCells), lineage_path(ResultsRoot, Prefix), Fields)
+
+def load_lineage(ResultsRoot, Prefix='0'):
+    # Empty index if the position was tracked without lineage
+    return LineageIndex(Results.read_tsv(lineage_path(ResultsRoot, Prefix)))
+
+class LineageIndex:
+    def __init__(self, Table):
+        self.Mothers = {}        # Daughter name: mother name
+        self.Daughters = {}      # Mother name: [daughter names]
+        self.DivisionFrame = {}  # Mother name: frame of the division
+        for Row in Table:
+            Mother = Row['Mother']
+            self.Mothers[Row['Daughter']] = Mother
+            self.Daughters.setdefault(Mother, []).append(Row['Daughter'])
+            self.DivisionFrame[Mother] = int(float(Row['Frame']))
+        # First ancestor of each cell, and all cells descending from it
+        self.Roots = {}
+        self.Families = {}
+        for Mother in self.Daughters.keys():
+            if Mother not in self.Mothers:
+                self.add_family(Mother)
+
+    def add_family(self, Root):
+        Family = []
+        Stack = [Root]
+        while Stack:
+            CellName = Stack.pop()
+            Family.append(CellName)
+            self.Roots[CellName] = Root
+            Stack.extend(reversed(self.daughters(CellName)))
+        self.Families[Root] = Family
+
+    def __len__(self):
+        return len(self.Mothers)
+
+    def mother(self, CellName):
+        return self.Mothers.get(CellName)
+
+    def daughters(self, CellName):
+        return self.Daughters.get(CellName, [])
+
+    def division_frame(self, CellName):
+        # Frame at which CellName divided (None if it did not)
+        return self.DivisionFrame.get(CellName)
+
+    def ancestors(self, CellName):
+        # Mother, grand-mother... of CellName
+        Ancestors = []
+        Mother = self.mother(CellName)
+        while Mother:
+            Ancestors.append(Mother)
+            Mother = self.mother(Mother)
+        return Ancestors
+
+    def root(self, CellName):
+        return self.Roots.get(CellName, CellName)
+
+    def family(self, CellName):
+        # All cells of the same lineage, first ancestor first (depth-first)
+        return self.Families.get(self.root(CellName), [CellName])
@@ -0,0 +1,137 @@
+# Java modules
+from java.lang import Runtime
+from java.lang.management import ManagementFactory, MemoryType
+
+# Other modules
+import json
+import os
+import threading
+import time
+
+# Custom modules
+import Tracking.Results as Results
+
+'''
+Metrics of the processing of one position, to find which positions or
+stages are slow or use too much memory.
+
+start() creates the recorder of the position: the pipeline then records
+the wall time of its stages, the wall time of parts run many times within
+a stage (e.g. the splits of each frame, summed), and counts events (per
+frame, and in total).
+Nothing is recorded when no recorder was started.
+The recorder belongs to the thread that started it, so positions processed
+on different threads have their own. Counts are only recorded from that
+thread (not from Parallel jobs). save() or stop() ends the recording.
+
+save() writes:
+  - <Prefix>_Metrics.json: position, stages (time, heap at the end), parts (time),
+  totals, peak heap
+  - <Prefix>_Metrics.tsv: one row per frame, one column per count
+'''
+
+Local = threading.local()
+
+def heap_pools():
+    return [Pool for Pool in ManagementFactory.getMemoryPoolMXBeans() if Pool.getType() == MemoryType.HEAP]
+
+def used_heap():
+    myRuntime = Runtime.getRuntime()
+    return myRuntime.totalMemory() - myRuntime.freeMemory()
+
+class Recorder:
+    def __init__(self, Position):
+        self.Position = Position
+        self.Stages = []   # (name, time (s), used heap at the end (bytes))
+        self.Parts = {}    # Name: time (s), summed over each run of the part
+        self.Totals = {}
+        self.Frames = {}   # Frame: {count name: value}
+        self.Frame = None  # Frame the counts are recorded for
+        self.Start = time.time()
+        for Pool in heap_pools():
+            Pool.resetPeakUsage()
+
+    def peak_heap(self):
+        # Sum of the peaks of each heap pool since start (an upper bound of the peak heap)
+        return sum(Pool.getPeakUsage().getUsed() for Pool in heap_pools())
+
+    def report(self):
+        Report = {
+                'Position': self.Position,
+                'Total time': time.time() - self.Start,
+                'Stages': [{'Stage': Name, 'Time': Seconds, 'Heap': Heap} for Name, Seconds, Heap in self.Stages],
+                'Parts': self.Parts,
+                'Totals': self.Totals,
+                'Peak heap': self.peak_heap(),
+                }
+        return Report
+
+def current():
+    # Recorder of this thread (None if not recording)
+    return getattr(Local, 'Recorder', None)
+
+def start(Position):
+    Local.Recorder = Recorder(Position)
+    return Local.Recorder
+
+def stop():
+    # Stop recording on this thread, return the recorder
+    Current = current()
+    Local.Recorder = None
+    return Current
+
+def clock():
+    return time.time()
+
+def stage(Name, Start):
+    # Record the wall time of a stage started at Start (from clock())
+    Current = current()
+    if Current:
+        Current.Stages.append((Name, time.time() - Start, used_heap()))
+
+def part(Name, Start):
+    # Add the wall time since Start (from clock()) to the time of the part Name
+    Current = current()
+    if Current:
+        Current.Parts[Name] = Current.Parts.get(Name, 0.0) + time.time() - Start
+
+def summary(Report):
+    # One line for the log: time of each stage and part, peak heap
+    Times = ["%s %.1f s" % (Stage['Stage'], Stage['Time']) for Stage in Report['Stages']]
+    Times += ["%s %.1f s" % Item for Item in sorted(Report.get('Parts', {}).items())]
+    return ", ".join(Times) + ", peak heap %d MB" % (Report['Peak heap']/(1024*1024))
+
+def set_frame(Frame):
+    Current = current()
+    if Current:
+        Current.Frame = Frame
+
+def count(Name, n=1, Frame=None):
+    # Add n to the count, in total and for Frame (by default the current frame)
+    Current = current()
+    if not Current or not n:
+        return
+    Current.Totals[Name] = Current.Totals.get(Name, 0) + n
+    if Frame is None:
+        Frame = Current.Frame
+    if Frame is not None:
+        Counts = Current.Frames.setdefault(Frame, {})
+        Counts[Name] = Counts.get(Name, 0) + n
+
+def save(ResultsRoot, Prefix='0'):
+    # Save the metrics and stop recording
+    Current = stop()
+    if not Current:
+        return
+    Report = Current.report()
+    jsonfile = open(os.path.join(ResultsRoot, Prefix + '_Metrics.json'), 'w')
+    json.dump(Report, jsonfile, indent=2, sort_keys=True)
+    jsonfile.close()
+    Names = sorted(set(Name for Counts in Current.Frames.values() for Name in Counts.keys()))
+    Table = []
+    for Frame in sorted(Current.Frames.keys()):
+        Row = {'Frame': Frame}
+        Row.update(Current.Frames[Frame])
+        Table.append(Row)
+    Results.write_tsv(Table, os.path.join(ResultsRoot, Prefix + '_Metrics.tsv'), ['Frame'] + Names)
+    return Report
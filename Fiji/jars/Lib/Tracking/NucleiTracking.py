@@ -5,11 +5,17 @@ from ij.plugin.filter import GaussianBlur
 
 # Python modules
 from operator import itemgetter
+from collections import deque
+from itertools import izip, repeat
 import math
 
 # Custom modules
 import Tracking.Cells as Cells
 import Tracking.WatershedSplit as W_Split
+import Tracking.LabelImage as LabelImage
+import Tracking.Parallel as Parallel
+import Tracking.Assignment as Assignment
+import Tracking.Metrics as Metrics
 
 '''
 Author: Vicente Lebrec (vicente.lebrec@gustaveroussy.fr)
@@ -27,50 +33,81 @@ Any detected oversegmentation is fused back into a single ROI
 
 ##################
 
-class Node:
+# Shared placeholder for the lists that most nodes never fill
+NoNodes = ()
+
+class Node(object):
     '''
     All ROI in each frames are represented internally as 'Nodes'
       - Each Node is connected to all overlapping nodes in next and prev frames.
       - Each Node's list of prev overlap and next overlap are sorted according to overlap area.
       - Those (prev and next frames) sorted lists of overlapping nodes are
       used in the Gale-Shapley matching algorithm.
+    There are hundreds of thousands of nodes per position, so nodes have fixed
+    slots (no __dict__), and only hold the ROI statistics they need.
+    The ShapeRoi and the distance-matching lists are only created when needed.
     '''
-    def __init__(self, Roi, Frame):
+    __slots__ = ('Roi', 'Frame', '_shapeRoi', 'area', 'x', 'y', 'majorEllipse',
+            'sorted_overlap', 'sorted_dist', 'prevNodes', 'nextNodes', 'prevRanks', 'nextProposal',
+            'BestPrev', 'BestPrevRank', 'BestNext',
+            'prevNodes_noOL', 'nextNodes_noOL', 'prevRanks_dist', 'nextProposal_dist',
+            'BestPrev_dist', 'BestPrevRank_dist', 'BestNext_dist',
+            'Cluster', 'mother', 'cell')
+
+    def __init__(self, Roi, Frame, Stats=None):
         self.Roi = Roi
         self.Frame = Frame
-        self.shapeRoi = ShapeRoi(Roi)
-        # Info about ROI
-        RoiStats = Roi.getStatistics()
-        self.area = RoiStats.area
-        self.x = RoiStats.xCentroid
-        self.y = RoiStats.yCentroid
-        self.majorEllipse = RoiStats.major
+        self._shapeRoi = None
+        # Info about ROI: (area, xCentroid, yCentroid, major) if already measured
+        # during segmentation, else measured from the ROI mask
+        if Stats:
+            self.area, self.x, self.y, self.majorEllipse = Stats
+        else:
+            RoiStats = Roi.getStatistics()
+            self.area = RoiStats.area
+            self.x = RoiStats.xCentroid
+            self.y = RoiStats.yCentroid
+            self.majorEllipse = RoiStats.major
         # List of potential matches in prev and next frames
         self.sorted_overlap = False
         self.sorted_dist = False
         self.prevNodes = []
         self.nextNodes = []
+        # Rank of each prevNode in prevNodes, and index of next nextNode to propose to
+        self.prevRanks = {}
+        self.nextProposal = 0
         # The best next/prev nodes found by Gale-Shapley matching algorithm
         self.BestPrev = False
         self.BestPrevRank = None
         self.BestNext = False
-        # Matches on distance (not overlap)
-        self.prevNodes_noOL = []
-        self.nextNodes_noOL = []
+        # Matches on distance (not overlap), lists created by the first match
+        self.prevNodes_noOL = NoNodes
+        self.nextNodes_noOL = NoNodes
+        self.prevRanks_dist = None
+        self.nextProposal_dist = 0
         self.BestPrev_dist = False
         self.BestPrevRank_dist = None
         self.BestNext_dist = False
         # If undersegmented cluster:
-        self.Cluster = []  #List of all parent nodes to the currently undersegmented cluster
+        self.Cluster = NoNodes  #List of all parent nodes to the currently undersegmented cluster
         # If cytokinesis:
         self.mother = None
         # Associated to cell (name of cell)
         self.cell = None
 
+    @property
+    def shapeRoi(self):
+        # Only built when the ROI is intersected with another
+        if self._shapeRoi is None:
+            self._shapeRoi = ShapeRoi(self.Roi)
+        return self._shapeRoi
+
     # Functions to generate map of nodes
     def addPrevNode(self, prevNode, OverlapArea):
         Weight = OverlapArea
         self.prevNodes.append((Weight, prevNode))
+        if prevNode not in self.prevRanks:
+            self.prevRanks[prevNode] = len(self.prevNodes) - 1
 
     def addNextNode(self, nextNode, OverlapArea):
         Weight = OverlapArea
@@ -78,24 +115,35 @@ class Node:
 
     def addPrevNode_noOL(self, prevNode, distance): # near but no overlap
         Weight = distance
+        if not self.prevNodes_noOL:
+            self.prevNodes_noOL = []
+            self.prevRanks_dist = {}
         self.prevNodes_noOL.append((Weight, prevNode))
+        if prevNode not in self.prevRanks_dist:
+            self.prevRanks_dist[prevNode] = len(self.prevNodes_noOL) - 1
 
     def addNextNode_noOL(self, nextNode, distance): # near but no overlap
         Weight = distance
+        if not self.nextNodes_noOL:
+            self.nextNodes_noOL = []
         self.nextNodes_noOL.append((Weight, nextNode))
 
-    def testOverlap(self, prevNode):
-        prevShape = ShapeRoi(prevNode.Roi)
+    def linkOverlap(self, prevNode, OverlapArea):
+        prevNode.addNextNode(self, OverlapArea)
+        self.addPrevNode(prevNode, OverlapArea)
+
+    def testOverlap(self, prevNode, Shift=None):
+        # Move the prev ROI by the drift between the two frames
+        prevShape = shifted_shape(prevNode.Roi, Shift)
         overlap = prevShape.and(self.shapeRoi)
         if overlap.getLength() > 0:
             overlapArea = overlap.getStatistics().area
-            prevNode.addNextNode(self, overlapArea)
-            self.addPrevNode(prevNode, overlapArea)
+            self.linkOverlap(prevNode, overlapArea)
 
     def testDist(self, prevNode, dist):
-        #dist = distance(self, prevNode)
-        prevNode.addNextNode_noOL(self, distance)
-        self.addPrevNode_noOL(prevNode, distance)
+        # dist: distance(prevNode, self), already computed by the caller
+        prevNode.addNextNode_noOL(self, dist)
+        self.addPrevNode_noOL(prevNode, dist)
 
     # Functions to find best match among potential matches
     def sort_overlap(self, ForceSort=False):
@@ -103,30 +151,28 @@ class Node:
             # Rank prevNodes and nextNodes by weight (= OverlapArea/Area of current node)
             self.prevNodes.sort(reverse=True, key=itemgetter(0))
             self.nextNodes.sort(reverse=True, key=itemgetter(0))
+            self.prevRanks = rank_map(self.prevNodes)
+            self.nextProposal = 0
             self.sorted_overlap = True
 
     def sort_dist(self, ForceSort=False):
         if not self.sorted_dist or ForceSort==True:
             # Rank prevNodes and nextNodes by weight (= OverlapArea/Area of current node)
-            self.prevNodes_noOL.sort(reverse=False, key=itemgetter(0))
-            self.nextNodes_noOL.sort(reverse=False, key=itemgetter(0))
+            self.prevNodes_noOL = sorted(self.prevNodes_noOL, reverse=False, key=itemgetter(0))
+            self.nextNodes_noOL = sorted(self.nextNodes_noOL, reverse=False, key=itemgetter(0))
+            self.prevRanks_dist = rank_map(self.prevNodes_noOL)
+            self.nextProposal_dist = 0
             self.sorted_dist = True
 
     def Rank(self, Match):
-        # return rank of prevNode
-        i = 0
-        for weight, prevNode in self.prevNodes:
-            if Match is prevNode:
-                return i
-            i += 1
+        # return rank of prevNode (None if not a prevNode)
+        return self.prevRanks.get(Match)
 
     def Rank_dist(self, Match):
-        # return rank of prevNode
-        i = 0
-        for weight, prevNode in self.prevNodes_noOL:
-            if Match is prevNode:
-                return i
-            i += 1
+        # return rank of prevNode (None if not a prevNode)
+        if self.prevRanks_dist is None:
+            return None
+        return self.prevRanks_dist.get(Match)
 
     def findMatch(self, RemainingNodes, MatchingNextNodes):
         '''
@@ -134,17 +180,20 @@ class Node:
             - If potential matching node is alone: mark self as this potential match's partner
             - Else, if it already have a partner, take its place if self is better ranked in
             potential match preferences
+        Proposals resume after the last refused nextNode: a nextNode's partner can
+        only get better, so it would refuse self again
         '''
         #self.sort_overlap()
-        for nextNode in self.nextNodes:
-            PotentialMatch = nextNode[1]
+        while self.nextProposal < len(self.nextNodes):
+            PotentialMatch = self.nextNodes[self.nextProposal][1]
+            self.nextProposal += 1
             if not PotentialMatch.BestPrev: # If PotentialMatch doesn't have any partner yet
                 #PotentialMatch.sort_overlap()
                 PotentialMatch.BestPrev = self           # 1. Define self as PotentialMatch's best prev
                 PotentialMatch.BestPrevRank = PotentialMatch.Rank(self)
                 #PotentialMatch.Cluster = [Node for Node in self.Cluster] # if self is a cluster, it will be saved
                 self.BestNext = PotentialMatch           # 2. Define PotentialMatch as self's best next
-                MatchingNextNodes.append(PotentialMatch) # 3. Say a match was found for PotentialMatch
+                MatchingNextNodes.add(PotentialMatch) # 3. Say a match was found for PotentialMatch
                 return True
             else: # If PotentialMatch already have a partner
                 RivalNode = PotentialMatch.BestPrev
@@ -170,15 +219,16 @@ class Node:
             potential match preferences
         '''
         #self.sort_overlap()
-        for nextNode in self.nextNodes_noOL:
-            PotentialMatch = nextNode[1]
+        while self.nextProposal_dist < len(self.nextNodes_noOL):
+            PotentialMatch = self.nextNodes_noOL[self.nextProposal_dist][1]
+            self.nextProposal_dist += 1
             if not PotentialMatch.BestPrev_dist: # If PotentialMatch doesn't have any partner yet
                 #PotentialMatch.sort_overlap()
                 PotentialMatch.BestPrev_dist = self           # 1. Define self as PotentialMatch's best prev
                 PotentialMatch.BestPrevRank_dist = PotentialMatch.Rank_dist(self)
                 #PotentialMatch.Cluster = [Node for Node in self.Cluster] # if self is a cluster, it will be saved
                 self.BestNext_dist = PotentialMatch           # 2. Define PotentialMatch as self's best next
-                MatchingNextNodes.append(PotentialMatch) # 3. Say a match was found for PotentialMatch
+                MatchingNextNodes.add(PotentialMatch) # 3. Say a match was found for PotentialMatch
                 # Also set them as (general, not only dist) BestPrev or BestNext
                 PotentialMatch.BestPrev = self           # 1. Define self as PotentialMatch's best prev
                 self.BestNext = PotentialMatch           # 2. Define PotentialMatch as self's best next
@@ -204,15 +254,27 @@ class Node:
 
     # To mark as a cluster:
     def cluster_of(self, NodeList):
-        self.Cluster.extend(NodeList)
-        self.Cluster = list(set(self.Cluster))
+        self.Cluster = list(set(list(self.Cluster) + list(NodeList)))
+
+    # Streaming: drop links to the prev frame once it has been matched
+    def release_prev(self):
+        self.prevNodes = []
+        self.prevNodes_noOL = NoNodes
+        self.prevRanks = {}
+        self.prevRanks_dist = None
+        self.BestPrev = False
+        self.BestPrev_dist = False
+        self.Cluster = NoNodes
+        self.mother = None
+        self._shapeRoi = None
 
     # To fuse/split nodes (correcting segment. errors)
     def remove_prevNode(self, DelNode):
-        for i, (weight, Node) in enumerate(self.prevNodes):
-            if Node is DelNode:
-                del self.prevNodes[i]
-                break
+        # prevRanks gives the position of the first link to DelNode, no scan needed
+        i = self.prevRanks.get(DelNode)
+        if i is not None:
+            del self.prevNodes[i]
+            self.prevRanks = rank_map(self.prevNodes)
 
     def remove_nextNode(self, DelNode):
         for i, (weight, Node) in enumerate(self.nextNodes):
@@ -223,10 +285,222 @@ class Node:
 #########################################################################################
 
 # General functions
+def rank_map(WeightedNodes):
+    # {Node: rank} of a list of (weight, Node); first occurence wins
+    Ranks = {}
+    for i, (weight, myNode) in enumerate(WeightedNodes):
+        if myNode not in Ranks:
+            Ranks[myNode] = i
+    return Ranks
+
 def distance(Node1, Node2):
     # Compute distance between the two nodes' centroids
     return math.sqrt((Node1.x - Node2.x)**2 + (Node1.y - Node2.y)**2)
 
+class Grid:
+    '''
+    Uniform grid over node centroids, used to find all nodes of a frame
+    that are within a given distance of a point without an all-pairs scan.
+      - Each cell of the grid is CellSize wide and stores (index, node) pairs
+      - Queries return candidates in their original frame order, so that
+      results are identical to a linear scan of the frame
+    '''
+    def __init__(self, Nodes, CellSize):
+        self.CellSize = float(max(CellSize, 1))
+        self.Cells = {}
+        for i, myNode in enumerate(Nodes):
+            self.insert(i, myNode)
+
+    def key(self, x, y):
+        return (int(math.floor(x / self.CellSize)), int(math.floor(y / self.CellSize)))
+
+    def insert(self, Index, myNode):
+        self.Cells.setdefault(self.key(myNode.x, myNode.y), []).append((Index, myNode))
+
+    def query_indexed(self, x, y, maxDistance):
+        # Return (index, node) of all nodes strictly nearer than maxDistance from (x, y)
+        cx, cy = self.key(x, y)
+        r = int(math.ceil(maxDistance / self.CellSize))
+        Found = []
+        for i in range(cx - r, cx + r + 1):
+            for j in range(cy - r, cy + r + 1):
+                for Index, myNode in self.Cells.get((i, j), []):
+                    if math.sqrt((myNode.x - x)**2 + (myNode.y - y)**2) < maxDistance:
+                        Found.append((Index, myNode))
+        Found.sort(key=itemgetter(0))
+        return Found
+
+    def query(self, x, y, maxDistance):
+        # Return all nodes strictly nearer than maxDistance from (x, y)
+        return [myNode for Index, myNode in self.query_indexed(x, y, maxDistance)]
+
+## Candidate gating for distance matches
+# Kalman model: gate size, in standard deviations of the predicted position
+GateSigmas = 3.0
+PositionNoise = 2.0      # Noise of centroid positions (px)
+AccelerationNoise = 3.0  # Change of velocity from one frame to the next (px/frame)
+SpeedNoise = 0.3         # Part of the speed that may change (widens the gate along the motion)
+
+def kalman_start(z, maxDistance):
+    # State of one axis of a new track: (position, velocity, covariance P00, P01, P11)
+    # Its velocity is unknown, so its gate is about maxDistance wide
+    SpeedStd = maxDistance/GateSigmas
+    return (z, 0.0, PositionNoise**2, 0.0, SpeedStd**2)
+
+def kalman_predict(State):
+    # Constant velocity prediction of one axis, one frame later
+    p, v, P00, P01, P11 = State
+    q = AccelerationNoise**2 + (SpeedNoise*v)**2
+    return (p + v, v, P00 + 2*P01 + P11 + q/4, P01 + P11 + q/2, P11 + q)
+
+def kalman_update(State, z):
+    # Predict one axis, then correct it with the measured position z
+    p, v, P00, P01, P11 = kalman_predict(State)
+    S = P00 + PositionNoise**2
+    K0 = P00/S
+    K1 = P01/S
+    Innovation = z - p
+    return (p + K0*Innovation, v + K1*Innovation, (1 - K0)*P00, (1 - K0)*P01, P11 - K1*P01)
+
+class Gating:
+    '''
+    Candidates for distance matching between the nodes of frame n and n+1
+      - 'None': nodes of frame n+1 within maxDistance of the centroid in frame n
+      - 'Kalman': a constant velocity Kalman filter follows each track (x and y filtered
+      separately), and nodes of frame n+1 are gated in an ellipse around the predicted
+      position. The ellipse is wide for new tracks, narrows as a track goes on, and
+      stretches along the axis a cell moves on
+    With the Kalman model, overlaps with frame n+1 can also be searched around the
+    predicted position only (see overlap_gate), once frame n-1 is matched (track_stream)
+    The number of candidate pairs of each frame is kept in Candidates, and recorded
+    as 'Distance candidates' in the metrics
+    '''
+    def __init__(self, maxDistance, Model='None'):
+        self.maxDistance = maxDistance
+        self.Model = Model
+        self.Kalman = Model == 'Kalman'
+        self.States = {}      # Node of frame n: (x state, y state) of its track
+        self.Candidates = []  # Number of candidate pairs of each frame
+
+    def state(self, myNode):
+        State = self.States.get(myNode)
+        if State is None:
+            State = (kalman_start(myNode.x, self.maxDistance), kalman_start(myNode.y, self.maxDistance))
+        return State
+
+    def update(self, NextNodes):
+        # Once frame n is matched with frame n+1, move each track to its node in frame n+1
+        if not self.Kalman:
+            return
+        States = {}
+        for nextNode in NextNodes:
+            if nextNode.BestPrev:
+                xState, yState = self.state(nextNode.BestPrev)
+                States[nextNode] = (kalman_update(xState, nextNode.x), kalman_update(yState, nextNode.y))
+        self.States = States
+
+    def candidates(self, Nodes, NextNodes):
+        '''
+        Pairs of Nodes[i] (frame n) and NextNodes[j] (frame n+1) within the gate, ordered by (j, i)
+        Return a list of (i, j, Distance, Score):
+          - Distance from the centroid (or the predicted position) of Nodes[i]
+          - Score from 0 (same position) to 1 (edge of the gate)
+        '''
+        Pairs = []
+        if not self.Kalman:
+            myGrid = Grid(Nodes, self.maxDistance)
+            for j, nextNode in enumerate(NextNodes):
+                for i, myNode in myGrid.query_indexed(nextNode.x, nextNode.y, self.maxDistance):
+                    dist = distance(myNode, nextNode)
+                    Pairs.append((i, j, dist, dist/self.maxDistance))
+        else:
+            nextGrid = Grid(NextNodes, self.maxDistance)
+            for i, myNode in enumerate(Nodes):
+                xState, yState = self.state(myNode)
+                px, vx, Px, P01, P11 = kalman_predict(xState)
+                py, vy, Py, P01, P11 = kalman_predict(yState)
+                Sx = Px + PositionNoise**2
+                Sy = Py + PositionNoise**2
+                Radius = GateSigmas*math.sqrt(max(Sx, Sy))
+                for j, nextNode in nextGrid.query_indexed(px, py, Radius):
+                    dx = nextNode.x - px
+                    dy = nextNode.y - py
+                    Mahalanobis = math.sqrt(dx*dx/Sx + dy*dy/Sy)
+                    if Mahalanobis < GateSigmas:
+                        Pairs.append((i, j, math.sqrt(dx*dx + dy*dy), Mahalanobis/GateSigmas))
+            Pairs.sort(key=lambda Pair: (Pair[1], Pair[0]))
+        self.Candidates.append(len(Pairs))
+        Metrics.count('Distance candidates', len(Pairs))
+        return Pairs
+
+    def overlap_gate(self, myNode):
+        '''
+        Circle (x, y, radius) of frame n+1 where the nodes overlapping myNode (frame n)
+        may be, or None if myNode has no known track (then the maxDistance circle is used)
+          - The track of the best overlap of myNode in frame n-1 is moved to myNode,
+          then predicted one frame later
+          - The radius is the gate of the prediction, plus the length of myNode,
+          so that both daughters of a division are still found
+        '''
+        if not self.Kalman or not myNode.prevNodes:
+            return None
+        prevNode = max(myNode.prevNodes, key=itemgetter(0))[1]
+        State = self.States.get(prevNode)
+        if State is None:
+            return None
+        px, vx, Px, P01, P11 = kalman_predict(kalman_update(State[0], myNode.x))
+        py, vy, Py, P01, P11 = kalman_predict(kalman_update(State[1], myNode.y))
+        Radius = GateSigmas*math.sqrt(max(Px, Py) + PositionNoise**2) + myNode.majorEllipse
+        return (px, py, Radius)
+
+    def report(self):
+        if self.Candidates:
+            IJ.log(">> Distance candidates per frame (motion model: " + self.Model + "): mean %.1f, max %d" % (
+                float(sum(self.Candidates))/len(self.Candidates), max(self.Candidates)))
+
+class FrameNodes(object):
+    '''
+    Nodes of one frame, with O(1) append, remove and membership test
+      - The position of each node in the frame is indexed by the node itself
+      - A removed node leaves a hole (None) that iteration skips, and holes
+      are dropped once they are half of the frame
+    Nodes are iterated in the same order as a list they would be appended to
+    and removed from. Indexing is only meant for frames with no node removed
+    (node i has label i+1 in the label image of the frame)
+    '''
+    def __init__(self, Nodes=()):
+        self.Slots = []
+        self.Position = {}
+        self.extend(Nodes)
+
+    def append(self, myNode):
+        self.Position[myNode] = len(self.Slots)
+        self.Slots.append(myNode)
+
+    def extend(self, Nodes):
+        for myNode in Nodes:
+            self.append(myNode)
+
+    def remove(self, myNode):
+        i = self.Position.pop(myNode, None)
+        if i is not None:
+            self.Slots[i] = None
+            if 2*len(self.Position) < len(self.Slots):
+                self.Slots = [Slot for Slot in self.Slots if Slot is not None]
+                self.Position = dict((Slot, i) for i, Slot in enumerate(self.Slots))
+
+    def __contains__(self, myNode):
+        return myNode in self.Position
+
+    def __len__(self):
+        return len(self.Position)
+
+    def __iter__(self):
+        return (Slot for Slot in self.Slots if Slot is not None)
+
+    def __getitem__(self, i):
+        return self.Slots[i]
+
 def remove_node(DelNode, Nodes):
     i = 0
     while i < len(Nodes):
@@ -236,176 +510,432 @@ def remove_node(DelNode, Nodes):
         else:
             i += 1
 
+def drift_shift(Drift):
+    # Drift between two frames, rounded to whole pixels (to move ROIs)
+    if not Drift:
+        return (0, 0)
+    return (int(round(Drift[0])), int(round(Drift[1])))
+
+def frame_shift(Drifts, Frame):
+    # Shift (whole pixels) from frame Frame - 1 to frame Frame (numbered from 1)
+    if Drifts and 1 < Frame <= len(Drifts):
+        return drift_shift(Drifts[Frame - 1])
+    return (0, 0)
+
+def shifted_shape(Roi, Shift):
+    # ShapeRoi of Roi, moved by Shift (the drift to the next frame)
+    myShape = ShapeRoi(Roi)
+    if Shift and Shift != (0, 0):
+        Bounds = myShape.getBounds()
+        myShape.setLocation(Bounds.x + Shift[0], Bounds.y + Shift[1])
+    return myShape
+
+def shifted_distance(prevNode, myNode, Shift):
+    # Distance between two nodes, once prevNode is moved by the drift
+    return math.sqrt((prevNode.x + Shift[0] - myNode.x)**2 + (prevNode.y + Shift[1] - myNode.y)**2)
+
+def bounds_intersect(prevBounds, Bounds, Shift):
+    # Bounding boxes of two ROIs intersect, once the prev one is moved by the drift
+    # If not, their shapes cannot overlap
+    x = prevBounds.x + Shift[0]
+    y = prevBounds.y + Shift[1]
+    return (x < Bounds.x + Bounds.width and Bounds.x < x + prevBounds.width
+            and y < Bounds.y + Bounds.height and Bounds.y < y + prevBounds.height)
+
+def link_overlaps(prevNodes, Nodes, maxDistance, Shift=(0, 0), Gate=None):
+    # Index prev nodes so that only nodes within maxDistance are tested
+    # Shift: drift between the two frames, compensated for
+    # Gate: if given, pairs outside the overlap gate of the prev node are not tested
+    # Shapes are only intersected if the bounding boxes of the ROIs do
+    # Return the number of pairs tested
+    prevGrid = Grid(prevNodes, maxDistance)
+    prevBounds = {}
+    Circles = {}
+    Tested = 0
+    for myNode in Nodes:
+        Bounds = myNode.Roi.getBounds()
+        for prevNode in prevGrid.query(myNode.x - Shift[0], myNode.y - Shift[1], maxDistance):
+            if prevNode not in prevBounds:
+                prevBounds[prevNode] = prevNode.Roi.getBounds()
+            if not bounds_intersect(prevBounds[prevNode], Bounds, Shift):
+                continue
+            if Gate is not None:
+                if prevNode not in Circles:
+                    Circles[prevNode] = Gate.overlap_gate(prevNode)
+                Circle = Circles[prevNode]
+                if Circle and math.sqrt((myNode.x - Circle[0])**2 + (myNode.y - Circle[1])**2) >= Circle[2]:
+                    continue
+            myNode.testOverlap(prevNode, Shift)
+            Tested += 1
+    return Tested
+
+def link_label_overlaps(prevNodes, Nodes, OverlapTable, maxDistance, Shift=(0, 0)):
+    # Link nodes of two consecutive frames from their label image overlap table
+    # Labels are (index + 1) of the node in its frame
+    # Return the number of pairs tested (overlapping pairs)
+    OverlapsPerNode = {}
+    for (prevLabel, Label), OverlapArea in OverlapTable.iteritems():
+        OverlapsPerNode.setdefault(Label, []).append((prevLabel, OverlapArea))
+    # Link in frame order, as the geometric path does
+    for Label in sorted(OverlapsPerNode.keys()):
+        myNode = Nodes[Label - 1]
+        for prevLabel, OverlapArea in sorted(OverlapsPerNode[Label]):
+            prevNode = prevNodes[prevLabel - 1]
+            if shifted_distance(prevNode, myNode, Shift) < maxDistance:
+                myNode.linkOverlap(prevNode, OverlapArea)
+    return len(OverlapTable)
+
+def frame_to_nodes(RoiList, Frame, StatsList=None):
+    if StatsList is None:
+        return [Node(Roi, Frame) for Roi in RoiList]
+    return [Node(Roi, Frame, Stats) for Roi, Stats in zip(RoiList, StatsList)]
+
+def link_frame_pair(prevNodes, Nodes, prevRois, Rois, maxDistance, LabelEngine, width, height, Drift=None, Gate=None):
+    # Only touches prevNodes' nextNodes and Nodes' prevNodes,
+    # so that each pair of frames can be linked independently
+    # Drift: (dx, dy) from the prev frame to this one (see Drift.py), compensated for
+    # Gate: motion model of the tracks so far, to test only the pairs near the
+    # predicted positions (ROI geometry only, label images count all overlaps at once)
+    # Return the number of overlapping pairs tested
+    Shift = drift_shift(Drift)
+    if LabelEngine:
+        # prev ROIs are drawn moved by the drift
+        prevLabels = LabelImage.rasterize(prevRois, width, height, -Shift[0], -Shift[1])
+        Labels = LabelImage.rasterize(Rois, width, height)
+        OverlapTable = LabelImage.overlap_table(prevLabels, Labels, [Roi.getBounds() for Roi in Rois])
+        return link_label_overlaps(prevNodes, Nodes, OverlapTable, maxDistance, Shift)
+    return link_overlaps(prevNodes, Nodes, maxDistance, Shift, Gate)
+
 # Generate map of all nodes and their matches between frames
 # Return a list of all nodes, ordered by the frame they are in
-def roi_to_nodes(RoiPerFrames, TrackParam):
+# StatsPerFrames: (area, x, y, major) of each ROI, as measured by Segment
+# Drifts: (dx, dy) of each frame from the previous one, if the stage drifted (see Drift.py)
+def roi_to_nodes(RoiPerFrames, TrackParam, imp, StatsPerFrames=None, Drifts=None):
     maxDistance = TrackParam['Max Distance']
+    # 'ROI geometry': intersect each pair of nearby ROIs
+    # 'Label image': count overlaps from one pass over two label images
+    LabelEngine = TrackParam.get('Overlap engine', 'ROI geometry') == 'Label image'
+    nThreads = TrackParam.get('Threads', Parallel.default_threads())
     IJ.log("Mapping all frame-to-frame ROI overlaps...")
-    NodesPerFrame = []
-    Frame = 0
     MaxFrame = len(RoiPerFrames)
-    while Frame < MaxFrame:
-        #IJ.log("> Frame " + str(Frame + 1) + "/" + str(MaxFrame))
-        IJ.showStatus("Frame " + str(Frame) + "/" + str(MaxFrame))
-        IJ.showProgress(Frame, MaxFrame)
-        NodesInFrame = []
-        for Roi in RoiPerFrames[Frame]:
-            myNode = Node(Roi, Frame + 1)
-            if Frame != 0:
-                for prevNode in NodesPerFrame[Frame - 1]:
-                    if distance(myNode, prevNode) < maxDistance:
-                        myNode.testOverlap(prevNode)
-            NodesInFrame.append(myNode)
-        NodesPerFrame.append(NodesInFrame)
-        Frame += 1
-    return NodesPerFrame
+    # 1. Convert the ROIs of each frame into nodes
+    IJ.showStatus("Creating nodes (" + str(MaxFrame) + " frames)")
+    if StatsPerFrames is None:
+        StatsPerFrames = [None]*MaxFrame
+    if Drifts is None:
+        Drifts = [None]*MaxFrame
+    NodesPerFrame = Parallel.run_tasks(frame_to_nodes,
+            [(RoiPerFrames[Frame], Frame + 1, StatsPerFrames[Frame]) for Frame in range(MaxFrame)], nThreads)
+    # 2. Link the nodes of each pair of frames (n-1, n)
+    IJ.showStatus("Mapping overlaps (" + str(MaxFrame) + " frames)")
+    Pairs = []
+    for Frame in range(1, MaxFrame):
+        Pairs.append((NodesPerFrame[Frame - 1], NodesPerFrame[Frame],
+            RoiPerFrames[Frame - 1], RoiPerFrames[Frame],
+            maxDistance, LabelEngine, imp.getWidth(), imp.getHeight(), Drifts[Frame]))
+    Tested = Parallel.run_tasks(link_frame_pair, Pairs, nThreads)
+    for Frame in range(MaxFrame):
+        Metrics.count('Nodes', len(NodesPerFrame[Frame]), Frame + 1)
+        if Frame > 0:
+            Metrics.count('Overlap pairs', Tested[Frame - 1], Frame + 1)
+    return [FrameNodes(Nodes) for Nodes in NodesPerFrame]
 
-def find_best_matches(NodesPerFrame, TrackParam, imp):
-    ## Tracking parameters
-    maxDistance = TrackParam['Max Distance']
-    w_sigma = TrackParam['Watershed sigma']
-    w_input = TrackParam['Watershed input']
-    DistanceBackup = TrackParam['BackupDistance']
+## Frame-to-frame matching
+def match_overlap(Nodes, NextNodes):
+    '''
+    Gale-Shapley matching between two frames, on overlap preferences
+    Return the nodes of frame n without match (rejected),
+    and the nodes of frame n+1 without match
+    '''
+    RemainingNodes = deque(Nodes)
+    MatchingNextNodes = set() # All nextNodes that matched
+    RejectedNodes = []
 
-    IJ.log("Finding best matches among overlaps...")
-    MaxFrame = len(NodesPerFrame) - 1
-    CurrentFrame = 0
-    SeedNodes = NodesPerFrame[0] # All of the nodes in the first frame are necessarily Seed Nodes
-    while CurrentFrame < MaxFrame:
-        # Find best matches for Nodes on current frame
-        RemainingNodes = [Node for Node in NodesPerFrame[CurrentFrame]]
-        AllNextNodes = [Node for Node in NodesPerFrame[CurrentFrame + 1]]
-        MatchingNextNodes = [] # List of all nextNodes that matched
-        RejectedNodes = []
-        
-        for Node in RemainingNodes:
-            Node.sort_overlap(ForceSort=True)
-        for Node in AllNextNodes:
-            Node.sort_overlap(ForceSort=True)
-        i = 0
-        while RemainingNodes: # Won't loop if there are no detected nodes in the frame
-            Node = RemainingNodes[i]
-            # Try to find a match among potential nextNodes
-            if Node.findMatch(RemainingNodes, MatchingNextNodes): # True if a match is found, False if rejected by all potential matches
-                del RemainingNodes[i] # Remove Node from RemainingNodes
-            else: # If no match is found or rejected by all next Nodes
-                RejectedNodes.append(RemainingNodes.pop(i))
-            # If end of RemainingNodes list is reached, then return to beginning
-            if i == len(RemainingNodes): # What's the point of those two lines??!
-                i = 0                    # i is not incremented anyway, it will only trigger if len(RemainingNodes) is 0...
-            # If no Nodes remain or if no matches are found anymore (ie: all remaining nodes are rejected), exit the loop
-            if len(RemainingNodes) == 0:
-                break
+    for Node in Nodes:
+        Node.sort_overlap(ForceSort=True)
+    for Node in NextNodes:
+        Node.sort_overlap(ForceSort=True)
+    while RemainingNodes: # Won't loop if there are no detected nodes in the frame
+        Node = RemainingNodes.popleft()
+        # Try to find a match among potential nextNodes
+        # Rival nodes losing their match are appended back to RemainingNodes
+        if not Node.findMatch(RemainingNodes, MatchingNextNodes): # False if rejected by all potential matches
+            RejectedNodes.append(Node)
+    Metrics.count('Proposals', sum(Node.nextProposal for Node in Nodes))
+    RemainingNextNodes = [nextNode for nextNode in NextNodes if nextNode not in MatchingNextNodes]
+    return RejectedNodes, RemainingNextNodes
+
+def match_dist(RemainingNodes, AllNextNodes, Gate):
+    '''
+    Gale-Shapley matching between the remaining nodes of two frames, on distance
+    Return the nodes of frame n+1 without match
+    '''
+    # Then I need to test distance between those Nodes in current and next frame
+    # Only the pairs within the gate are tested, in the same order as a nested loop
+    for i, j, dist, Score in Gate.candidates(RemainingNodes, AllNextNodes):
+        AllNextNodes[j].testDist(RemainingNodes[i], dist)
+
+    MatchingNextNodes = set() # All nextNodes that matched
+    RejectedNodes = []
+
+    for Node in RemainingNodes:
+        Node.sort_dist(ForceSort=True)
+    for Node in AllNextNodes:
+        Node.sort_dist(ForceSort=True)
+    Nodes = RemainingNodes
+    RemainingNodes = deque(RemainingNodes)
+    while RemainingNodes: # Won't loop if there are no detected nodes in the frame
+        Node = RemainingNodes.popleft()
+        # Try to find a match among potential nextNodes
+        if not Node.findMatch_dist(RemainingNodes, MatchingNextNodes): # False if rejected by all potential matches
+            RejectedNodes.append(Node)
+    Metrics.count('Proposals', sum(Node.nextProposal_dist for Node in Nodes))
+    Metrics.count('Distance matches', len(MatchingNextNodes))
+    return [nextNode for nextNode in AllNextNodes if nextNode not in MatchingNextNodes]
+
+def match_assignment(Nodes, NextNodes, Gate, DistanceBackup):
+    '''
+    Global optimal assignment between two frames:
+      - Overlapping nodes can be linked, with cost 1 - overlap/(largest area)
+      - If DistanceBackup, nodes without any overlap can be linked to the nodes within
+      their gate (e.g. nearer than maxDistance) that have no overlap either,
+      with cost 1 + distance/maxDistance (always worse than any overlap)
+      - Any node of frame n can die, any node of frame n+1 can be born (cost 1)
+    Splits and merges are then tested on the dead and born nodes,
+    the same way as for Gale-Shapley rejected nodes.
+    Return the nodes of frame n without match (dead),
+    and the nodes of frame n+1 without match (born)
+    '''
+    for Node in Nodes:
+        Node.sort_overlap(ForceSort=True)
+    for Node in NextNodes:
+        Node.sort_overlap(ForceSort=True)
+    NextIndex = dict((nextNode, j) for j, nextNode in enumerate(NextNodes))
+    Edges = {}
+    for i, Node in enumerate(Nodes):
+        for OverlapArea, nextNode in Node.nextNodes:
+            Edges[(i, NextIndex[nextNode])] = 1 - float(OverlapArea)/max(Node.area, nextNode.area)
+    if DistanceBackup:
+        # Lone nodes (no overlap candidate) of both frames, by index
+        LoneIndex = [i for i, Node in enumerate(Nodes) if not Node.nextNodes]
+        LoneNextIndex = [j for j, nextNode in enumerate(NextNodes) if not nextNode.prevNodes]
+        for a, b, dist, Score in Gate.candidates([Nodes[i] for i in LoneIndex],
+                [NextNodes[j] for j in LoneNextIndex]):
+            Edges[(LoneIndex[a], LoneNextIndex[b])] = 1 + Score
+    Links = Assignment.sparse_assignment(Edges, 1.0, 1.0)
+    Metrics.count('Distance matches', len([Link for Link in Links if Edges[Link] > 1]))
+    for i, j in Links:
+        Nodes[i].BestNext = NextNodes[j]
+        NextNodes[j].BestPrev = Nodes[i]
+    RejectedNodes = [Node for Node in Nodes if not Node.BestNext]
+    RemainingNextNodes = [nextNode for nextNode in NextNodes if not nextNode.BestPrev]
+    return RejectedNodes, RemainingNextNodes
+
+## Segmentation errors
+def split_undersegmented(RejectedNodes, NodesPerFrame, CurrentFrame, imp, w_sigma, nThreads=1, Drifts=None):
+    '''
+    If any Node remains in Frame n, test if undersegmentation occured in next frame
+    Clusters are split, and the nodes that were part of a cluster are removed from RejectedNodes
+    The watersheds of all clusters run on nThreads, then the graph is updated cluster by cluster
+    Drifts: the overlaps of split nodes with frame n+2 compensate the drift, as the cluster's did
+    '''
+    UndersegmentedNodes = []
+    FoundClusters = set()
+    for Node in RejectedNodes:
+        Node.sort_overlap(ForceSort=True) #TODO necessary?
+        if len(Node.nextNodes) != 0:
+            myMatch = Node.nextNodes[0][1] # Best potential match in next frame
+            RivalNode = myMatch.BestPrev # Best match of myMatch
+            if not RivalNode:
+                continue
+            # If sum of Node and Rival area is nearer to myMatch area than RivalNode area, then it's an undersegmentation
+            SumArea = Node.area + RivalNode.area
+            if abs(myMatch.area - SumArea) < abs(myMatch.area - RivalNode.area):
+                myMatch.cluster_of([Node, RivalNode])
+                # In the order clusters are found, so that merging is deterministic
+                if myMatch not in FoundClusters:
+                    FoundClusters.add(myMatch)
+                    UndersegmentedNodes.append(myMatch)
+                remove_node(Node, RejectedNodes)
+    Metrics.count('Splits', len(UndersegmentedNodes))
+    # Each cluster gets its own processor of the frame, the watershed is done on its bounding box
+    Stack = imp.getStack()
+    Start = Metrics.clock()
+    RoisPerCluster = Parallel.run_tasks(split_rois,
+            [(ClusterNode, Stack.getProcessor(ClusterNode.Frame), w_sigma) for ClusterNode in UndersegmentedNodes],
+            nThreads)
+    Metrics.part('Split', Start)
+    for ClusterNode, RoiList in zip(UndersegmentedNodes, RoisPerCluster):
+        splitNodes = split_node(ClusterNode, RoiList, frame_shift(Drifts, ClusterNode.Frame + 1))
+        NodesPerFrame[CurrentFrame + 1].remove(ClusterNode)
+        NodesPerFrame[CurrentFrame + 1].extend(splitNodes)
+    return RejectedNodes
 
-        # If any Node remains in Frame n, test if undersegmentation occured in next frame
-        UndersegmentedNodes = set()
-        for Node in RejectedNodes:
-            Node.sort_overlap(ForceSort=True) #TODO necessary?
-            if len(Node.nextNodes) != 0:
-                myMatch = Node.nextNodes[0][1] # Best potential match in next frame
-                RivalNode = myMatch.BestPrev # Best match of myMatch
-                # If sum of Node and Rival area is nearer to myMatch area than RivalNode area, then it's an undersegmentation
-                SumArea = Node.area + RivalNode.area
-                if abs(myMatch.area - SumArea) < abs(myMatch.area - RivalNode.area):
-                    myMatch.cluster_of([Node, RivalNode])
-                    UndersegmentedNodes.add(myMatch)
-                    remove_node(Node, RejectedNodes)
-        UndersegmentedNodes = list(UndersegmentedNodes)
-        W_input = None
-        for ClusterNode in UndersegmentedNodes:
-            splitNodes, W_input = split_node(ClusterNode, imp, W_input, w_sigma)
-            remove_node(ClusterNode, NodesPerFrame[CurrentFrame+1])
-            NodesPerFrame[CurrentFrame + 1].extend(splitNodes)
-
-        # If any Node from frame n+1 wasn't matched with frame n, test if oversegmentation
-        RemainingNextNodes = list(set(AllNextNodes) - set(MatchingNextNodes))
-        LoneNextNodes = []
-        for Node in RemainingNextNodes:
-            Node.sort_overlap(ForceSort=True) #TODO necessary?
-            if len(Node.prevNodes) != 0 and not Node.prevNodes[0][1].BestNext == False:
-                myMatch = Node.prevNodes[0][1]
-                RivalNode = myMatch.BestNext
-                # Use area to identify a potential oversegmentation
-                SumArea = Node.area + RivalNode.area
-                #if abs(myMatch.area - SumArea) < abs(myMatch.area - RivalNode.area):
-                if abs(myMatch.area - SumArea) < myMatch.area*0.1:
-                    if abs(RivalNode.area - Node.area) < RivalNode.area*0.1:
-                        distNodes = distance(Node, RivalNode)
-                        if distNodes > 55 and distNodes > 1.2*min(Node.majorEllipse, RivalNode.majorEllipse):  #Cytokinesis:
-                            is_cytok = True
-                        else:
-                            is_cytok = False
+def fuse_oversegmented(RemainingNextNodes, NodesPerFrame, CurrentFrame, SeedNodes, Drifts=None):
+    '''
+    If any Node from frame n+1 wasn't matched with frame n, test if oversegmentation
+      - Cytokinesis: both daughters are added to SeedNodes
+      - Oversegmentation: both nodes are fused back into a single node
+    Return the remaining nodes of frame n+1 (LoneNextNodes)
+    '''
+    LoneNextNodes = []
+    for Node in RemainingNextNodes:
+        Node.sort_overlap(ForceSort=True) #TODO necessary?
+        if len(Node.prevNodes) != 0 and not Node.prevNodes[0][1].BestNext == False:
+            myMatch = Node.prevNodes[0][1]
+            RivalNode = myMatch.BestNext
+            # Use area to identify a potential oversegmentation
+            SumArea = Node.area + RivalNode.area
+            #if abs(myMatch.area - SumArea) < abs(myMatch.area - RivalNode.area):
+            if abs(myMatch.area - SumArea) < myMatch.area*0.1:
+                if abs(RivalNode.area - Node.area) < RivalNode.area*0.1:
+                    distNodes = distance(Node, RivalNode)
+                    if distNodes > 55 and distNodes > 1.2*min(Node.majorEllipse, RivalNode.majorEllipse):  #Cytokinesis:
+                        is_cytok = True
                     else:
                         is_cytok = False
-                    if is_cytok: # Cytokinesis
-                        myMatch.BestNext = False
-                        Node.mother = myMatch
-                        RivalNode.mother = myMatch
-                        SeedNodes.extend([Node, RivalNode])
-                    else: # Genuine oversegmentation:
-                        FusedNode = fuse_nodes(Node, RivalNode) # Fuse Node and RivalNode into a single Node
-                        myMatch.BestNext = FusedNode # Set the fused node as myMatch bestNext
-                        FusedNode.BestPrev = myMatch # Set myMatch as FusedNode bestPrev
-                        if CurrentFrame + 1 < len(NodesPerFrame): # If not last frame
-                            # Remove Node and RivalNode from the list of Nodes in the next frame
-                            remove_node(Node, NodesPerFrame[CurrentFrame+1])
-                            remove_node(RivalNode, NodesPerFrame[CurrentFrame+1])
-                            # Add the fused Node to the list of Nodes in the next frame
-                            NodesPerFrame[CurrentFrame + 1].append(FusedNode)
                 else:
-                    # Add Node to the list of SeedNodes
-                    #SeedNodes.append(Node)
-                    LoneNextNodes.append(Node)
+                    is_cytok = False
+                if is_cytok: # Cytokinesis
+                    Metrics.count('Cytokineses')
+                    myMatch.BestNext = False
+                    Node.mother = myMatch
+                    RivalNode.mother = myMatch
+                    SeedNodes.extend([Node, RivalNode])
+                else: # Genuine oversegmentation:
+                    Metrics.count('Fusions')
+                    # Fuse Node and RivalNode into a single Node
+                    FusedNode = fuse_nodes(Node, RivalNode, frame_shift(Drifts, Node.Frame), frame_shift(Drifts, Node.Frame + 1))
+                    myMatch.BestNext = FusedNode # Set the fused node as myMatch bestNext
+                    FusedNode.BestPrev = myMatch # Set myMatch as FusedNode bestPrev
+                    if CurrentFrame + 1 < len(NodesPerFrame): # If not last frame
+                        # Remove Node and RivalNode from the list of Nodes in the next frame
+                        NodesPerFrame[CurrentFrame + 1].remove(Node)
+                        NodesPerFrame[CurrentFrame + 1].remove(RivalNode)
+                        # Add the fused Node to the list of Nodes in the next frame
+                        NodesPerFrame[CurrentFrame + 1].append(FusedNode)
             else:
                 # Add Node to the list of SeedNodes
                 #SeedNodes.append(Node)
                 LoneNextNodes.append(Node)
-
-        # Among remaining nodes, test if same node using distance
-        # Remaining Nodes should be all Nodes in current frame with no match in next frame
-        RemainingNodes = RejectedNodes
-        # AllNextNodes should be all Nodes in next frame with no match in current frame
-        AllNextNodes = LoneNextNodes
-        if DistanceBackup:
-            # Then I need to test distance between those Nodes in current and next frame
-            for nextNode in AllNextNodes:
-                for prevNode in RemainingNodes:
-                    dist = distance(prevNode, nextNode)
-                    if dist < maxDistance:
-                        nextNode.testDist(prevNode, dist)
-
-            MatchingNextNodes = [] # List of all nextNodes that matched
-            RejectedNodes = []
-            
-            for Node in RemainingNodes:
-                Node.sort_dist(ForceSort=True)
-            for Node in AllNextNodes:
-                Node.sort_dist(ForceSort=True)
-            i = 0
-            while RemainingNodes: # Won't loop if there are no detected nodes in the frame
-                Node = RemainingNodes[i]
-                # Try to find a match among potential nextNodes
-                if Node.findMatch_dist(RemainingNodes, MatchingNextNodes): # True if a match is found, False if rejected by all potential matches
-                    del RemainingNodes[i] # Remove Node from RemainingNodes
-                else: # If no match is found or rejected by all next Nodes
-                    RejectedNodes.append(RemainingNodes.pop(i))
-                # If end of RemainingNodes list is reached, then return to beginning
-                if i == len(RemainingNodes):
-                    i = 0
-                # If no Nodes remain or if no matches are found anymore (ie: all remaining nodes are rejected), exit the loop
-                if len(RemainingNodes) == 0:
-                    break
-            RemainingNextNodes = list(set(AllNextNodes) - set(MatchingNextNodes))
-            SeedNodes.extend(RemainingNextNodes)
         else:
-            SeedNodes.extend(AllNextNodes)
+            # Add Node to the list of SeedNodes
+            #SeedNodes.append(Node)
+            LoneNextNodes.append(Node)
+    return LoneNextNodes
+
+def match_frame(NodesPerFrame, CurrentFrame, TrackParam, imp, SeedNodes, Gate=None, Drifts=None):
+    '''
+    Match the nodes of frame n (CurrentFrame) with the nodes of frame n+1
+    Nodes of frame n+2 must already be mapped, as splits and fusions in frame n+1
+    update their overlaps. New seed nodes (in frame n+1) are appended to SeedNodes
+    Gate gives the candidates for distance matching (within maxDistance by default)
+    Drifts: the drift of each frame from the previous one (indexed by frame, as in roi_to_nodes)
+    '''
+    ## Tracking parameters
+    maxDistance = TrackParam['Max Distance']
+    w_sigma = TrackParam['Watershed sigma']
+    DistanceBackup = TrackParam['BackupDistance']
+    # 'Gale-Shapley': stable matching on overlap, then on distance
+    # 'Global assignment': one optimal assignment on overlap and distance
+    GlobalAssignment = TrackParam.get('Linking', 'Gale-Shapley') == 'Global assignment'
+    if Gate is None:
+        Gate = Gating(maxDistance)
+
+    # Find best matches for Nodes on current frame
+    Nodes = [Node for Node in NodesPerFrame[CurrentFrame]]
+    NextNodes = [Node for Node in NodesPerFrame[CurrentFrame + 1]]
+    if GlobalAssignment:
+        RejectedNodes, RemainingNextNodes = match_assignment(Nodes, NextNodes, Gate, DistanceBackup)
+    else:
+        RejectedNodes, RemainingNextNodes = match_overlap(Nodes, NextNodes)
 
+    # Undersegmentation in frame n+1: split clusters
+    RejectedNodes = split_undersegmented(RejectedNodes, NodesPerFrame, CurrentFrame, imp, w_sigma,
+            TrackParam.get('Threads', Parallel.default_threads()), Drifts)
+    # Oversegmentation in frame n+1: fuse nodes or mark cytokinesis
+    LoneNextNodes = fuse_oversegmented(RemainingNextNodes, NodesPerFrame, CurrentFrame, SeedNodes, Drifts)
+
+    # Among remaining nodes, test if same node using distance
+    # (already part of the global assignment)
+    if DistanceBackup and not GlobalAssignment:
+        # RejectedNodes: all Nodes in current frame with no match in next frame
+        # LoneNextNodes: all Nodes in next frame with no match in current frame
+        LoneNextNodes = match_dist(RejectedNodes, LoneNextNodes, Gate)
+    SeedNodes.extend(LoneNextNodes)
+    # Tracks now end in frame n+1
+    Gate.update(NodesPerFrame[CurrentFrame + 1])
+
+def find_best_matches(NodesPerFrame, TrackParam, imp, Drifts=None):
+    IJ.log("Finding best matches among overlaps...")
+    MaxFrame = len(NodesPerFrame) - 1
+    CurrentFrame = 0
+    SeedNodes = list(NodesPerFrame[0]) # All of the nodes in the first frame are necessarily Seed Nodes
+    Gate = Gating(TrackParam['Max Distance'], TrackParam.get('Motion model', 'None'))
+    while CurrentFrame < MaxFrame:
+        # Counts are recorded for frame n+1 (frames are numbered from 1)
+        Metrics.set_frame(CurrentFrame + 2)
+        match_frame(NodesPerFrame, CurrentFrame, TrackParam, imp, SeedNodes, Gate, Drifts)
         # Go to next frame
         CurrentFrame += 1
+    Metrics.set_frame(None)
+    Gate.report()
     return SeedNodes
 
+## Overlaps of fused/split nodes
+# Overlaps are updated from the overlaps already known (fusion) or from label images (split)
+# With DebugOverlaps, each of them is also intersected geometrically, and differences are logged
+DebugOverlaps = False
+
+def check_overlap(myNode, prevNode, OverlapArea, Shift=(0, 0)):
+    # Compare an overlap area with the geometric intersection of the two ROIs
+    # Shift: drift from the frame of prevNode to the frame of myNode
+    overlap = shifted_shape(prevNode.Roi, Shift).and(myNode.shapeRoi)
+    Geometric = 0
+    if overlap.getLength() > 0:
+        Geometric = overlap.getStatistics().area
+    if abs(Geometric - OverlapArea) >= 1:
+        IJ.log("Frame " + str(myNode.Frame) + ": overlap " + str(OverlapArea) + " instead of " + str(Geometric))
+
+def summed_overlaps(WeightedNodes1, WeightedNodes2):
+    # Two nodes of a frame don't overlap, so their union overlaps a node by the sum of both overlaps
+    Overlaps = {}
+    OrderedNodes = []
+    for WeightedNodes in (WeightedNodes1, WeightedNodes2):
+        Counted = set()
+        for weight, myNode in WeightedNodes:
+            if myNode in Counted:
+                continue
+            Counted.add(myNode)
+            if myNode not in Overlaps:
+                Overlaps[myNode] = 0
+                OrderedNodes.append(myNode)
+            Overlaps[myNode] += weight
+    return [(Overlaps[myNode], myNode) for myNode in OrderedNodes]
+
+def split_overlaps(ClusterNode, splitNodes, Shift=(0, 0)):
+    '''
+    Overlaps of the nodes a cluster was split into with the next nodes of the cluster,
+    counted on label images of the cluster bounding box (split nodes are inside the cluster)
+    Shift: drift to the next frame, the next nodes are moved back by it (as in link_frame_pair)
+    Return a list of (OverlapArea, splitNode, nextNode)
+    '''
+    NextNodes = []
+    for weight, nextNode in ClusterNode.nextNodes:
+        if nextNode not in NextNodes:
+            NextNodes.append(nextNode)
+    Bounds = ClusterNode.Roi.getBounds()
+    SplitLabels = LabelImage.rasterize([splitNode.Roi for splitNode in splitNodes],
+            Bounds.width, Bounds.height, Bounds.x, Bounds.y)
+    NextLabels = LabelImage.rasterize([nextNode.Roi for nextNode in NextNodes],
+            Bounds.width, Bounds.height, Bounds.x + Shift[0], Bounds.y + Shift[1])
+    OverlapTable = LabelImage.overlap_table(SplitLabels, NextLabels)
+    # Same order as testing each next node for each split node
+    return [(OverlapTable[(i, j)], splitNodes[i - 1], NextNodes[j - 1]) for i, j in sorted(OverlapTable)]
+
 ## Nodes fusion
-def fuse_nodes(Node1, Node2):
+def fuse_nodes(Node1, Node2, prevShift=(0, 0), nextShift=(0, 0)):
+    # prevShift, nextShift: drifts from the previous frame and to the next one, only to check overlaps
     FusedRoi = ShapeRoi(Node1.Roi)
     ShapeRoi2 = ShapeRoi(Node2.Roi)
     FusedRoi.or(ShapeRoi2)
@@ -413,14 +943,16 @@ def fuse_nodes(Node1, Node2):
     # Create a new, fused, node
     FusedNode = Node(FusedRoi, Node1.Frame)
     # Fuse nextNodes lists:
-    CombinedNextNodes = list(set([myNode for weight, myNode in Node1.nextNodes + Node2.nextNodes]))
-    for nextNode in CombinedNextNodes:
-        nextNode.testOverlap(FusedNode)
+    for OverlapArea, nextNode in summed_overlaps(Node1.nextNodes, Node2.nextNodes):
+        if DebugOverlaps:
+            check_overlap(nextNode, FusedNode, OverlapArea, nextShift)
+        nextNode.linkOverlap(FusedNode, OverlapArea)
         nextNode.remove_prevNode(Node1)
         nextNode.remove_prevNode(Node2)
-    CombinedPrevNodes = list(set([myNode for weight, myNode in Node1.prevNodes + Node2.prevNodes]))
-    for prevNode in CombinedPrevNodes:
-        FusedNode.testOverlap(prevNode)
+    for OverlapArea, prevNode in summed_overlaps(Node1.prevNodes, Node2.prevNodes):
+        if DebugOverlaps:
+            check_overlap(FusedNode, prevNode, OverlapArea, prevShift)
+        FusedNode.linkOverlap(prevNode, OverlapArea)
         prevNode.remove_nextNode(Node1)
         prevNode.remove_nextNode(Node2)
         prevNode.sort_overlap(ForceSort=True)
@@ -437,16 +969,21 @@ def w_marker(Roi1, Roi2):
     x,y = imgstat.xCentroid, imgstat.yCentroid
     return (int(x),int(y))
 
-def split_node(ClusterNode, imp, W_input, w_sigma):
-    frame = ClusterNode.Frame
+def split_rois(ClusterNode, ip, w_sigma):
+    # Watershed of a cluster, one ROI per parent (None if lost)
+    # Doesn't change any node, so clusters can be split on different threads
     markers = []
     # Use centroids of overlaps between roi to split and its parents as markers for watershed
     for myNode in ClusterNode.Cluster:
         markers.append(w_marker(myNode.Roi, ClusterNode.Roi))
-    #IJ.log("Frame " + str(frame) + ": Cluster to split into " + str(len(markers)))
-    ip = imp.getProcessor()
-    imp.setPosition(frame)
-    RoiList, W_input = W_Split.split(ip, markers, ClusterNode.Roi, w_sigma, W_input)
+    #IJ.log("Frame " + str(ClusterNode.Frame) + ": Cluster to split into " + str(len(markers)))
+    RoiList, W_input = W_Split.split(ip, markers, ClusterNode.Roi, w_sigma, None)
+    return RoiList
+
+def split_node(ClusterNode, RoiList, Shift=(0, 0)):
+    # Replace a cluster by the nodes of its split ROIs, linked to its parents
+    # Shift: drift to the next frame
+    frame = ClusterNode.Frame
     splitNodes = []
     for Roi, parentNode in zip(RoiList, ClusterNode.Cluster):
         if Roi:
@@ -454,37 +991,211 @@ def split_node(ClusterNode, imp, W_input, w_sigma):
             splitNode = Node(Roi, frame)
             splitNode.BestPrev = parentNode
             parentNode.BestNext = splitNode
-            for weight, nextNode in ClusterNode.nextNodes:
-                nextNode.testOverlap(splitNode)
-                nextNode.remove_prevNode(ClusterNode)
             splitNodes.append(splitNode)
         else:
             parentNode.BestNext = False
-    return splitNodes, W_input
+    if splitNodes:
+        for OverlapArea, splitNode, nextNode in split_overlaps(ClusterNode, splitNodes, Shift):
+            if DebugOverlaps:
+                check_overlap(nextNode, splitNode, OverlapArea, Shift)
+            nextNode.linkOverlap(splitNode, OverlapArea)
+        for weight, nextNode in ClusterNode.nextNodes:
+            nextNode.remove_prevNode(ClusterNode)
+    return splitNodes
 
 ########################################
 
+## Gap closing
+def track_end(Seed):
+    # Last node of the track started by Seed
+    CurrentNode = Seed
+    while CurrentNode.BestNext:
+        CurrentNode = CurrentNode.BestNext
+    return CurrentNode
+
+def close_gaps(SeedNodes, TrackParam, Drifts=None):
+    '''
+    Join the end of each track to the start of a track up to 'Gap frames' frames
+    later (a nucleus missed in between), within 'Gap distance' once the drift is compensated
+      - Track starts are indexed per frame in a Grid, so each end is only
+      compared with the nearby starts of the next few frames
+      - Joins are chosen greedily: shortest gap first, then nearest
+      - Tracks ending in a cytokinesis, and tracks of daughters, are never joined
+    Return {end node: start node}, and the seed nodes that still start a cell
+    '''
+    maxGap = int(TrackParam.get('Gap frames', 0))
+    if maxGap < 1:
+        return {}, SeedNodes
+    maxDistance = TrackParam.get('Gap distance', TrackParam['Max Distance'])
+    Mothers = set(Seed.mother for Seed in SeedNodes if Seed.mother)
+    StartGrids = {}
+    for Index, Seed in enumerate(SeedNodes):
+        if not Seed.mother:
+            StartGrids.setdefault(Seed.Frame, Grid([], maxDistance)).insert(Index, Seed)
+    # All (end, start) pairs within reach
+    Candidates = []
+    for EndIndex, Seed in enumerate(SeedNodes):
+        End = track_end(Seed)
+        if End in Mothers:
+            continue
+        dx, dy = 0.0, 0.0
+        for Frame in range(End.Frame + 1, End.Frame + maxGap + 2):
+            if Drifts and Frame <= len(Drifts):
+                dx += Drifts[Frame - 1][0]
+                dy += Drifts[Frame - 1][1]
+            if Frame == End.Frame + 1 or Frame not in StartGrids:
+                continue
+            for StartIndex, Start in StartGrids[Frame].query_indexed(End.x + dx, End.y + dy, maxDistance):
+                Distance = shifted_distance(End, Start, (dx, dy))
+                Candidates.append((Frame - End.Frame - 1, Distance, EndIndex, StartIndex, End, Start))
+    Candidates.sort(key=itemgetter(0, 1, 2, 3))
+    Joins = {}
+    Joined = set()
+    for Gap, Distance, EndIndex, StartIndex, End, Start in Candidates:
+        if End not in Joins and StartIndex not in Joined:
+            Joins[End] = Start
+            Joined.add(StartIndex)
+    IJ.log("Gap closing: " + str(len(Joins)) + " tracks joined")
+    Metrics.count('Gaps closed', len(Joins))
+    return Joins, [Seed for Index, Seed in enumerate(SeedNodes) if Index not in Joined]
+
 ## Generate list of cells from linked nodes
-def seednodes_to_cell(SeedNodes, PosValue):
+def seednodes_to_cell(SeedNodes, PosValue, Joins=None):
+    # Joins: {end node: start node} from close_gaps, frames in between are blank lines
     myCells = []
     for Seed in SeedNodes:
         myCell = Cells.Cell(Pos=PosValue) # Create a new cell object from SeedNode's Roi
         myCell.addNucleus(Seed.Roi)
         Seed.cell = myCell.name
         CurrentNode = Seed
-        while CurrentNode.BestNext: #As long as there are next nodes in the node's daughters
-            CurrentNode = CurrentNode.BestNext
-            myCell.addNucleus(CurrentNode.Roi) #Add CurrentNode to cell
+        while True:
+            while CurrentNode.BestNext: #As long as there are next nodes in the node's daughters
+                CurrentNode = CurrentNode.BestNext
+                myCell.addNucleus(CurrentNode.Roi) #Add CurrentNode to cell
+                CurrentNode.cell = myCell.name
+            if not Joins or CurrentNode not in Joins:
+                break
+            # The track goes on after a gap (only once if several tracks reach this end)
+            Start = Joins.pop(CurrentNode)
+            for Frame in range(CurrentNode.Frame + 1, Start.Frame):
+                myCell.addBlankLine(Frame)
+            CurrentNode = Start
+            myCell.addNucleus(CurrentNode.Roi)
             CurrentNode.cell = myCell.name
         myCells.append(myCell)
+    # Lineage: daughters start a cell, and their mother node belongs to the mother cell
+    for Seed, myCell in zip(SeedNodes, myCells):
+        if Seed.mother:
+            myCell.mother = Seed.mother.cell
     return myCells
 
+## Streaming tracking
+def extend_cells(OpenCells, SeedNodes, PosValue):
+    '''
+    Follow the BestNext of the last node of each open cell (frame n)
+    Return the cells whose track ended, and start a new cell from each seed
+    '''
+    FinishedCells = []
+    StillOpen = []
+    for myCell, LastNode in OpenCells:
+        if LastNode.BestNext:
+            CurrentNode = LastNode.BestNext
+            myCell.addNucleus(CurrentNode.Roi)
+            CurrentNode.cell = myCell.name
+            StillOpen.append((myCell, CurrentNode))
+        else:
+            FinishedCells.append(myCell)
+    for Seed in SeedNodes:
+        myCell = Cells.Cell(Pos=PosValue)
+        myCell.addNucleus(Seed.Roi)
+        Seed.cell = myCell.name
+        if Seed.mother:
+            myCell.mother = Seed.mother.cell
+        StillOpen.append((myCell, Seed))
+    return FinishedCells, StillOpen
+
+def track_stream(RoiFrames, TrackParam, imp, PosValue, StatsFrames=None, Drifts=None):
+    '''
+    Streaming version of track():
+      - RoiFrames can be any iterable of per-frame ROI lists (e.g. a generator),
+      and StatsFrames an iterable of the matching per-frame ROI measurements
+      - Drifts: the drift of each frame from the previous one, if any
+      - Only the nodes of three frames are kept: frame n is matched with frame n+1
+      once frame n+2 is mapped (splits and fusions in frame n+1 update its overlaps)
+      - Cells are yielded as soon as their track ends, and the nodes of matched
+      frames are released, so memory does not grow with the length of the movie
+    Cells are created in the same order (and with the same names) as with track()
+    Gaps are not closed (see close_gaps), as tracks are yielded as soon as they end
+    With the Kalman motion model, the overlaps of frame n+2 are only tested near the
+    positions predicted from the tracks matched up to frame n (see Gating.overlap_gate)
+    '''
+    maxDistance = TrackParam['Max Distance']
+    LabelEngine = TrackParam.get('Overlap engine', 'ROI geometry') == 'Label image'
+    Gate = Gating(maxDistance, TrackParam.get('Motion model', 'None'))
+    Window = []      # Nodes of the frames kept in memory
+    OpenCells = []   # (cell, last node) of all tracks that may still continue
+    prevRois = None
+    Frame = 0
+    if StatsFrames is None:
+        StatsFrames = repeat(None)
+    for RoiList, StatsList in izip(RoiFrames, StatsFrames):
+        Frame += 1
+        IJ.showStatus("Tracking frame " + str(Frame))
+        Nodes = frame_to_nodes(RoiList, Frame, StatsList)
+        Metrics.count('Nodes', len(Nodes), Frame)
+        if Window:
+            Tested = link_frame_pair(Window[-1], Nodes, prevRois, RoiList,
+                    maxDistance, LabelEngine, imp.getWidth(), imp.getHeight(),
+                    Drifts[Frame - 1] if Drifts else None, Gate if Gate.Kalman else None)
+            Metrics.count('Overlap pairs', Tested, Frame)
+        else:
+            # All of the nodes in the first frame are necessarily Seed Nodes
+            FinishedCells, OpenCells = extend_cells(OpenCells, Nodes, PosValue)
+        Window.append(FrameNodes(Nodes))
+        prevRois = RoiList
+        if len(Window) == 3:
+            Metrics.set_frame(Frame - 1)
+            for myCell in match_window(Window, TrackParam, imp, PosValue, OpenCells, Gate, Drifts):
+                yield myCell
+    # No more frames: match the last pair
+    while len(Window) > 1:
+        # Window[0] is frame Frame - len(Window) + 1, counts are for the next one
+        Metrics.set_frame(Frame - len(Window) + 2)
+        for myCell in match_window(Window, TrackParam, imp, PosValue, OpenCells, Gate, Drifts):
+            yield myCell
+    Metrics.set_frame(None)
+    Gate.report()
+    for myCell, LastNode in OpenCells:
+        yield myCell
+
+def match_window(Window, TrackParam, imp, PosValue, OpenCells, Gate=None, Drifts=None):
+    # Match the first two frames of the window, then drop the first one
+    SeedNodes = []
+    match_frame(Window, 0, TrackParam, imp, SeedNodes, Gate, Drifts)
+    FinishedCells, OpenCells[:] = extend_cells(OpenCells, SeedNodes, PosValue)
+    # Nodes of frame n+1 no longer need their links to frame n
+    for myNode in Window[1]:
+        myNode.release_prev()
+    del Window[0]
+    return FinishedCells
+
 ## Main function
-def track(RoiPerFrames, TrackParam, imp, PosValue):
+def track(RoiPerFrames, TrackParam, imp, PosValue, StatsPerFrames=None, Drifts=None):
     # Convert ROIs to nodes in a graph
-    NodesPerFrame = roi_to_nodes(RoiPerFrames, TrackParam)
+    Start = Metrics.clock()
+    NodesPerFrame = roi_to_nodes(RoiPerFrames, TrackParam, imp, StatsPerFrames, Drifts)
+    Metrics.stage('Overlaps', Start)
     # Find best match for each node, and return the first node of each path
-    SeedNodes = find_best_matches(NodesPerFrame, TrackParam, imp)
+    Start = Metrics.clock()
+    SeedNodes = find_best_matches(NodesPerFrame, TrackParam, imp, Drifts)
+    Metrics.stage('Matching', Start)
+    # Join tracks interrupted by missing detections
+    Start = Metrics.clock()
+    Joins, SeedNodes = close_gaps(SeedNodes, TrackParam, Drifts)
+    Metrics.stage('Gap closing', Start)
     # Convert the nodes to cells
-    myCells = seednodes_to_cell(SeedNodes, PosValue)
+    Start = Metrics.clock()
+    myCells = seednodes_to_cell(SeedNodes, PosValue, Joins)
+    Metrics.stage('Cells', Start)
+    Metrics.count('Cells', len(myCells))
     return myCells
@@ -0,0 +1,36 @@
+# Java modules
+from java.lang import Runtime
+from java.util.concurrent import Executors, Callable
+
+'''
+Run independent jobs on a java.util.concurrent thread pool.
+Jython has no GIL, so jobs on different threads truly run in parallel.
+Jobs must not modify any state shared with the other jobs.
+'''
+
+class Task(Callable):
+    def __init__(self, Function, Args):
+        self.Function = Function
+        self.Args = Args
+
+    def call(self):
+        return self.Function(*self.Args)
+
+def default_threads():
+    return Runtime.getRuntime().availableProcessors()
+
+def run_tasks(Function, ArgsList, nThreads):
+    '''
+    Call Function(*Args) for each Args in ArgsList, using nThreads workers
+    Return the list of results, in the same order as ArgsList
+    '''
+    nThreads = int(nThreads)
+    if nThreads <= 1 or len(ArgsList) <= 1:
+        return [Function(*Args) for Args in ArgsList]
+    Pool = Executors.newFixedThreadPool(min(nThreads, len(ArgsList)))
+    try:
+        Futures = [Pool.submit(Task(Function, Args)) for Args in ArgsList]
+        # get() waits for each job, so results are joined in order
+        return [Future.get() for Future in Futures]
+    finally:
+        Pool.shutdown()
@@ -1,11 +1,18 @@
 from ij import IJ, ImagePlus, ImageStack
-from ij.process import ByteProcessor
-from ij.plugin.filter import MaximumFinder
+from ij.process import ByteProcessor, ImageProcessor, ImageStatistics
+from ij.plugin.filter import MaximumFinder, Analyzer, ParticleAnalyzer, ThresholdToSelection
+from ij.measure import Measurements, ResultsTable
 from ij.gui import Wand, PolygonRoi, Roi
 from inra.ijpb.watershed import MarkerControlledWatershedTransform2D as MWatershed
 from inra.ijpb.binary import BinaryImages
 from inra.ijpb.morphology.strel import DiskStrel as Disk
 from inra.ijpb.morphology import Morphology
+import threading
+import time
+
+# Custom modules
+import Tracking.Parallel as Parallel
+import Tracking.Metrics as Metrics
 
 ##################### WATERSHED THRESHOLDING (with mask) #########################
 def generate_input_bkp(next_imp, method):
@@ -108,32 +115,47 @@ def generate_markerip(markers, ip):
     return marker_ip
 
 def find_minimum(ip):
-    xmin, ymin = 0,0
-    minpix = 65535
-    x = 0
-    while x < 1024:
-        y = 0
-        while y < 1024:
-            pixelVal = ip.get(x,y)
-            if pixelVal < minpix:
-                minpix = pixelVal
-                xmin = x
-                ymin = y
-            y += 1
-        x += 1
-    return xmin,ymin
-
-def segment_frame(input_ip, mask_ip, marker_ip, frame, Tolerance, DiskRadius):
+    # Location of the darkest pixel, whatever the image size
+    # Same pixel as a column by column scan: first column holding the minimum, then first row
+    MinValue = ImageStatistics.getStatistics(ip, Measurements.MIN_MAX, None).min
+    # Pixels at the minimum are outlined by Java: the first column is the left of their bounds
+    ip.setThreshold(MinValue, MinValue, ImageProcessor.NO_LUT_UPDATE)
+    MinRoi = ThresholdToSelection().convert(ip)
+    ip.resetThreshold()
+    if MinRoi is None:
+        return 0, 0
+    Bounds = MinRoi.getBounds()
+    # Only this column is read pixel by pixel
+    for y in range(Bounds.y, Bounds.y + Bounds.height):
+        if ip.getf(Bounds.x, y) == MinValue:
+            return Bounds.x, y
+    return Bounds.x, Bounds.y
+
+# Structuring element of each worker thread
+WorkerDisk = threading.local()
+
+def worker_disk(DiskRadius):
+    # Built once per thread, instead of once per frame
+    if getattr(WorkerDisk, 'Radius', None) != DiskRadius:
+        WorkerDisk.Disk = Disk.fromRadius(DiskRadius)
+        WorkerDisk.Radius = DiskRadius
+    return WorkerDisk.Disk
+
+def gradient_frame(input_stack, frame, DiskRadius):
+    # Contour image of one frame
+    return Morphology.externalGradient(input_stack.getProcessor(frame), worker_disk(DiskRadius))
+
+def segment_frame(gradient_ip, mask_ip, marker_ip, frame, Tolerance, Timing=None):
     print frame
     # Find markers
     markers = find_markers(marker_ip, Tolerance)
     # Find minimum marker and prepend it to list of markers (pos 0)
+    Start = time.time()
     min_marker = find_minimum(marker_ip)
+    if Timing is not None:
+        Timing['Background marker'] += time.time() - Start
     markers.insert(0, min_marker)
     marker_ip = generate_markerip(markers, marker_ip)
-    # Make contour image
-    myDisk = Disk.fromRadius(DiskRadius)
-    gradient_ip = Morphology.externalGradient(input_ip, myDisk)
     # Do watershed
     Watershed = MWatershed(gradient_ip, marker_ip, mask_ip, 4)
     Watershed.setVerbose(False)
@@ -141,6 +163,7 @@ def segment_frame(input_ip, mask_ip, marker_ip, frame, Tolerance, DiskRadius):
     # Convert each region into a Roi
     myWand = Wand(W_ip)
     RoiInFrame = []
+    StatsInFrame = []
     # use magic wand to get the watersheded ROIs
     for x,y in markers: #markers[1:] to remove the background ROI (in pos 0)
         if W_ip.get(x,y) != 0: 
@@ -152,58 +175,90 @@ def segment_frame(input_ip, mask_ip, marker_ip, frame, Tolerance, DiskRadius):
                 myRoi.setPosition(frame)
                 if Area < UpperArea:
                     RoiInFrame.append(myRoi)
-    return RoiInFrame, W_ip
+                    StatsInFrame.append((Area, RoiStats.xCentroid, RoiStats.yCentroid, RoiStats.major))
+    return RoiInFrame, StatsInFrame, W_ip
+
+def watershed_frame(gradient_ip, mask_ip, marker_stack, frame, Tolerance):
+    # Segment one frame, on a worker thread (the watershed image isn't kept)
+    Timing = {'Background marker': 0.0}
+    RoiInFrame, StatsInFrame, W_ip = segment_frame(gradient_ip, mask_ip, marker_stack.getProcessor(frame),
+            frame, Tolerance, Timing)
+    return RoiInFrame, StatsInFrame, Timing['Background marker']
 
-def w_segment(wParam, imp):
+def w_segment(wParam, imp, nThreads=None):
     Tolerance = wParam['Tolerance']
     DiskRadius = wParam['DiskRadius']
     InputRB = wParam['InputRB']
     InputSigma = wParam['InputSigma']
     MarkerRB = wParam['MarkerRB']
     MarkerSigma = wParam['MarkerSigma']
+    if nThreads is None:
+        nThreads = Parallel.default_threads()
     IJ.log("Marker controlled watershed:")
     maxFrame = imp.getNSlices()
+    Frames = range(1, maxFrame + 1)
     # Generate input
     input_imp = imp.duplicate()
     if InputRB > 0:
         IJ.run(input_imp, "Subtract Background...", "rolling=" + str(InputRB) + " stack")
     IJ.run(input_imp, "Gaussian Blur...", "sigma=" + str(InputSigma) + " stack")
-    input_ip = input_imp.getProcessor()
+    # Make contour image of each frame
+    Start = time.time()
+    input_stack = input_imp.getStack()
+    GradientStack = Parallel.run_tasks(gradient_frame,
+            [(input_stack, i, DiskRadius) for i in Frames], nThreads)
     # Generate mask and the image markers will be found on
-    ##TODO generate a mask imp which is a full white 8bit image of same dimensions (except only one frame)
-    mask_ip = ByteProcessor(1024, 1024)
+    mask_ip = ByteProcessor(imp.getWidth(), imp.getHeight())
     mask_ip.set(255)
     marker_imp = imp.duplicate()
     if MarkerRB > 0:
         IJ.run(marker_imp, "Subtract Background...", "rolling=" + str(MarkerRB) + " stack")
     IJ.run(marker_imp, "Gaussian Blur...", "sigma=" + str(MarkerSigma) + " stack")
-    marker_ip = marker_imp.getProcessor()
+    marker_stack = marker_imp.getStack()
     # Find markers and segment each frame using watershed
+    # Frames are independent: the mask is only read, each frame has its own marker image
     IJ.log(">> Flood from local maxima...")
-    i = 1
-    RoiPerFrames = []
-    #W_stack = ImageStack(mask_ip.width, mask_ip.height)
-    while i <= maxFrame:
-        #IJ.log("Frame " + str(i))
-        input_imp.setPosition(i)
-        marker_imp.setPosition(i)
-        RoiInFrame, W_ip = segment_frame(input_ip, mask_ip, marker_ip, i, Tolerance, DiskRadius)
-        #W_stack.addSlice(W_ip)
-        RoiPerFrames.append(RoiInFrame)
-        i += 1
-    #W_imp = ImagePlus('Watershed', W_stack)
-    #W_imp.show()
-    return RoiPerFrames
+    Segmented = Parallel.run_tasks(watershed_frame,
+            [(GradientStack[i - 1], mask_ip, marker_stack, i, Tolerance) for i in Frames], nThreads)
+    RoiPerFrames = [RoiInFrame for RoiInFrame, StatsInFrame, MarkerTime in Segmented]
+    StatsPerFrames = [StatsInFrame for RoiInFrame, StatsInFrame, MarkerTime in Segmented]
+    if maxFrame > 0:
+        # Background marker time is summed over all threads
+        IJ.log(">> %.1f ms per frame, including %.1f ms to find the background marker" % (
+            1000 * (time.time() - Start) / maxFrame,
+            1000 * sum([MarkerTime for RoiInFrame, StatsInFrame, MarkerTime in Segmented]) / maxFrame))
+    return RoiPerFrames, StatsPerFrames
 
 
 ########### SIMPLE THRESHOLDING ################
-def RM_to_RoiPerFrames(RM, MaxFrame):
+def RM_to_RoiPerFrames(RM, MaxFrame, UnsortedStats):
+    # UnsortedStats are in the same order as the ROIs in the RoiManager
     UnsortedRois = RM.getRoisAsArray()
     RM.reset()
+    if len(UnsortedStats) != len(UnsortedRois):
+        # Particles weren't measured: tracking will measure the ROIs itself
+        UnsortedStats = [None]*len(UnsortedRois)
     SortedRois = [[] for k in range(MaxFrame)]
-    for Roi in UnsortedRois:
+    SortedStats = [[] for k in range(MaxFrame)]
+    for Roi, Stats in zip(UnsortedRois, UnsortedStats):
         SortedRois[Roi.getPosition() - 1].append(Roi)
-    return SortedRois
+        SortedStats[Roi.getPosition() - 1].append(Stats)
+    return SortedRois, SortedStats
+
+def to_pixels(cal, Area, X, Y, Major):
+    # Particle measurements are calibrated, convert them back to pixels
+    # (as Roi.getStatistics() measures them)
+    return (Area/(cal.pixelWidth * cal.pixelHeight), cal.getRawX(X), cal.getRawY(Y), Major/cal.pixelWidth)
+
+def read_particle_stats(cal):
+    # (area, x, y, major) of each particle, from the Results table of "Analyze Particles"
+    rt = ResultsTable.getResultsTable()
+    Stats = []
+    for i in range(rt.size()):
+        Stats.append(to_pixels(cal, rt.getValue('Area', i), rt.getValue('X', i),
+            rt.getValue('Y', i), rt.getValue('Major', i)))
+    rt.reset()
+    return Stats
 
 def threshold_apply(imp, method):
     MethodSteps = method.split(' ')
@@ -279,7 +334,75 @@ def threshold_apply(imp, method):
         if field[:3] == 'PA_':
             (area, circ) = field[3:].split('_')
             IJ.log(">> Particle Analysis: area=" + area + " circ=" + circ)
-            IJ.run(imp, "Analyze Particles...", "size=" + area + " circularity=" + circ + " clear add stack")
+            # Also measure what tracking needs (area, centroid, ellipse) of each particle
+            UserMeasurements = Analyzer.getMeasurements()
+            Analyzer.setMeasurements(Measurements.AREA + Measurements.CENTROID + Measurements.ELLIPSE)
+            IJ.run(imp, "Analyze Particles...", "size=" + area + " circularity=" + circ + " display clear add stack")
+            Analyzer.setMeasurements(UserMeasurements)
+
+########### SIMPLE THRESHOLDING (without RoiManager) ################
+class ParticleCollector(ParticleAnalyzer):
+    '''
+    Particle analyzer keeping the ROI and (area, x, y, major) of each particle,
+    instead of adding them to the (global) RoiManager and Results table
+    '''
+    def __init__(self, cal, minSize, maxSize, minCirc, maxCirc):
+        ParticleAnalyzer.__init__(self, 0, Measurements.AREA + Measurements.CENTROID + Measurements.ELLIPSE,
+                ResultsTable(), minSize, maxSize, minCirc, maxCirc)
+        self.cal = cal
+        self.Rois = []
+        self.Stats = []
+
+    def saveResults(self, stats, roi):
+        # Called by the particle analyzer for each particle found
+        self.Rois.append(roi)
+        self.Stats.append(to_pixels(self.cal, stats.area, stats.xCentroid, stats.yCentroid, stats.major))
+
+def parse_range(Range):
+    # 'min-max' (max can be 'Infinity') or 'min'
+    if '-' not in Range:
+        return float(Range), float('Infinity')
+    Min, Max = Range.split('-')
+    return float(Min), float(Max)
+
+def collect_particles(imp, area, circ):
+    '''
+    Same as "Analyze Particles... size=area circularity=circ add stack",
+    but return the ROIs and measurements of each frame directly
+    '''
+    minSize, maxSize = parse_range(area)
+    minCirc, maxCirc = parse_range(circ)
+    cal = imp.getCalibration()
+    # "size=" is in calibrated units, ParticleAnalyzer expects pixels
+    PixelArea = cal.pixelWidth * cal.pixelHeight
+    stack = imp.getStack()
+    RoiPerFrames = []
+    StatsPerFrames = []
+    for Frame in range(1, stack.getSize() + 1):
+        Collector = ParticleCollector(cal, minSize/PixelArea, maxSize/PixelArea, minCirc, maxCirc)
+        Collector.analyze(imp, stack.getProcessor(Frame))
+        for Roi in Collector.Rois:
+            Roi.setPosition(Frame)
+        RoiPerFrames.append(Collector.Rois)
+        StatsPerFrames.append(Collector.Stats)
+    return RoiPerFrames, StatsPerFrames
+
+def t_segment_noRM(orig_imp, method):
+    '''
+    Threshold-based segmentation that doesn't use the RoiManager,
+    so that several positions can be segmented at the same time
+    '''
+    IJ.log("Threshold-based segmentation:")
+    imp = orig_imp.duplicate()
+    Steps = method.split(' ')
+    ParticleSteps = [field for field in Steps if field[:3] == 'PA_']
+    threshold_apply(imp, ' '.join([field for field in Steps if field[:3] != 'PA_']))
+    if ParticleSteps:
+        (area, circ) = ParticleSteps[-1][3:].split('_')
+    else:
+        (area, circ) = ('0-Infinity', '0.00-1.00')
+    IJ.log(">> Particle Analysis: area=" + area + " circ=" + circ)
+    return collect_particles(imp, area, circ)
 
 def toBinary(imp, threshold):
     IJ.setRawThreshold(imp, int(Threshold), 65535, '');
@@ -291,15 +414,23 @@ def t_segment(orig_imp, method, RM):
     imp = orig_imp.duplicate()
     threshold_apply(imp, method)
     MaxFrame = imp.getNSlices()
-    RoiPerFrames = RM_to_RoiPerFrames(RM, MaxFrame)
-    return RoiPerFrames
+    RoiPerFrames, StatsPerFrames = RM_to_RoiPerFrames(RM, MaxFrame, read_particle_stats(imp.getCalibration()))
+    return RoiPerFrames, StatsPerFrames
 
 ##################################################
-def segment(imp, myMethod, RM):
+def segment(imp, myMethod, RM=None, nThreads=None):
+    # Return the ROIs of each frame, and their (area, x, y, major) measurements
+    # Without RM, thresholding doesn't go through the RoiManager
     print myMethod
+    Start = Metrics.clock()
     if 'Watershed' in myMethod['Name']:
         if not myMethod['Method']['Mask']:
-            RoiPerFrames = w_segment(myMethod['Method'],imp)
+            RoiPerFrames, StatsPerFrames = w_segment(myMethod['Method'], imp, nThreads)
+    elif RM:
+        RoiPerFrames, StatsPerFrames = t_segment(imp, myMethod['Method'], RM)
     else:
-        RoiPerFrames = t_segment(imp, myMethod['Method'], RM)
-    return RoiPerFrames
+        RoiPerFrames, StatsPerFrames = t_segment_noRM(imp, myMethod['Method'])
+    Metrics.stage('Segmentation', Start)
+    for Frame, RoiInFrame in enumerate(RoiPerFrames):
+        Metrics.count('ROIs', len(RoiInFrame), Frame + 1)
+    return RoiPerFrames, StatsPerFrames
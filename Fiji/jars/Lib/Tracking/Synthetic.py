@@ -0,0 +1,214 @@
+# Fiji modules
+from ij import ImagePlus, VirtualStack
+from ij.process import ImageProcessor, ShortProcessor
+from ij.plugin.filter import GaussianBlur
+
+# Other modules
+import math
+import random
+import threading
+
+'''
+Synthetic time-lapse of fluorescent nuclei (16-bit stack), with known tracks,
+to benchmark and check segmentation and tracking.
+
+Nuclei are discs on a flat background, blurred, with Gaussian noise:
+  - Density: fraction of the field covered by nuclei (sets the size of the field)
+  - Speed: displacement per frame (px), the direction drifts by Turn (radians) per frame
+  - Division: probability per frame that a (fully grown) nucleus divides.
+  Daughters have half the area, are DivisionSpread radii apart, then grow back.
+  The population stops dividing at twice the initial number of nuclei
+  - Touching: fraction of nuclei born touching another one, they move together
+  - Noise: standard deviation of the noise (grey levels)
+
+Ground truth: the (track id, x, y, radius) of each nucleus in each frame,
+and the (mother id, frame) of each daughter track.
+Memory: frames are drawn from the ground truth when they are read (virtual
+stack), only the last one is kept. A frame is 2 bytes per pixel, e.g. 2000
+nuclei at the default density and radius are on a ~3700 px field (27 MB),
+and a copy of the whole movie (e.g. by segmentation) takes 27 MB per frame.
+'''
+
+Background = 100
+Intensity = 1000
+DivisionSpread = 3.2  # Daughters are 3.2 radii apart: still overlap the mother, far enough for a cytokinesis
+Growth = 0.05         # Part of the missing radius that daughters grow back each frame
+
+class Nucleus:
+    def __init__(self, Id, x, y, Radius, Direction, Partner=None):
+        self.Id = Id
+        self.x = x
+        self.y = y
+        self.Radius = Radius
+        self.Direction = Direction
+        # Touching nucleus this one moves with
+        self.Partner = Partner
+
+def field_size(nNuclei, Radius, Density):
+    # Side of the square field where nNuclei cover a Density fraction of the area
+    return int(math.ceil(math.sqrt(nNuclei*math.pi*Radius**2/Density)))
+
+def free_position(Random, Side, Radius, Occupied):
+    # Random position at least 2 radii away from the other nuclei (if found in 100 tries)
+    # Occupied: grid of the nuclei already placed, in cells of 2 radii
+    for Try in range(100):
+        x = Random.uniform(Radius, Side - Radius)
+        y = Random.uniform(Radius, Side - Radius)
+        cx, cy = int(x/(2*Radius)), int(y/(2*Radius))
+        Near = [Other for i in (cx - 1, cx, cx + 1) for j in (cy - 1, cy, cy + 1) for Other in Occupied.get((i, j), [])]
+        if all([(Other.x - x)**2 + (Other.y - y)**2 >= (2*Radius)**2 for Other in Near]):
+            break
+    return x, y
+
+def seed_nuclei(Random, nNuclei, Side, Radius, Touching):
+    Nuclei = []
+    Occupied = {}
+    while len(Nuclei) < nNuclei:
+        if Nuclei:
+            Last = Nuclei[-1]
+            Occupied.setdefault((int(Last.x/(2*Radius)), int(Last.y/(2*Radius))), []).append(Last)
+        if Nuclei and Random.random() < Touching and Nuclei[-1].Partner is None:
+            # Touching the previous nucleus, slightly overlapping
+            Partner = Nuclei[-1]
+            Angle = Random.uniform(0, 2*math.pi)
+            x = Partner.x + 1.9*Radius*math.cos(Angle)
+            y = Partner.y + 1.9*Radius*math.sin(Angle)
+            if Radius <= x <= Side - Radius and Radius <= y <= Side - Radius:
+                myNucleus = Nucleus(len(Nuclei), x, y, Radius, Partner.Direction, Partner)
+                Partner.Partner = myNucleus
+                Nuclei.append(myNucleus)
+                continue
+        x, y = free_position(Random, Side, Radius, Occupied)
+        Nuclei.append(Nucleus(len(Nuclei), x, y, Radius, Random.uniform(0, 2*math.pi)))
+    return Nuclei
+
+def move(myNucleus, Random, Side, Speed, Turn, Moved):
+    # Random walk with persistence, bouncing on the borders of the field
+    r = myNucleus.Radius
+    if myNucleus.Partner is not None and myNucleus.Partner.Id in Moved:
+        dx, dy = Moved[myNucleus.Partner.Id]
+    else:
+        myNucleus.Direction += Random.gauss(0, Turn)
+        dx = Speed*math.cos(myNucleus.Direction)
+        dy = Speed*math.sin(myNucleus.Direction)
+        if not r <= myNucleus.x + dx <= Side - r:
+            dx = -dx
+            myNucleus.Direction = math.pi - myNucleus.Direction
+        if not r <= myNucleus.y + dy <= Side - r:
+            dy = -dy
+            myNucleus.Direction = -myNucleus.Direction
+    myNucleus.x = min(max(myNucleus.x + dx, r), Side - r)
+    myNucleus.y = min(max(myNucleus.y + dy, r), Side - r)
+    Moved[myNucleus.Id] = (dx, dy)
+
+def divide(myNucleus, Random, Side, FirstId):
+    # Two daughters of half the area, on each side of the mother
+    r = myNucleus.Radius/math.sqrt(2)
+    Angle = Random.uniform(0, math.pi)
+    Half = DivisionSpread*myNucleus.Radius/2
+    Daughters = []
+    for Sign in (-1, 1):
+        x = min(max(myNucleus.x + Sign*Half*math.cos(Angle), r), Side - r)
+        y = min(max(myNucleus.y + Sign*Half*math.sin(Angle), r), Side - r)
+        Daughters.append(Nucleus(FirstId + len(Daughters), x, y, r, Random.uniform(0, 2*math.pi)))
+    return Daughters
+
+def draw_frame(Nuclei, Side, Blur, Noise, NoiseSeed):
+    # Nuclei: (track id, x, y, radius) of each nucleus, as in the ground truth
+    ip = ShortProcessor(Side, Side)
+    ip.setValue(Background)
+    ip.fill()
+    ip.setValue(Background + Intensity)
+    for Id, x, y, r in Nuclei:
+        ip.fillOval(int(round(x - r)), int(round(y - r)), int(round(2*r)), int(round(2*r)))
+    if Blur > 0:
+        GaussianBlur().blurGaussian(ip, Blur)
+    if Noise > 0:
+        ImageProcessor.setRandomSeed(NoiseSeed)
+        ip.noise(Noise)
+    return ip
+
+class SyntheticStack(VirtualStack):
+    '''
+    Frames of a synthetic movie, drawn from its ground truth when read
+    The last frame read is kept, as tracking reads the same frame for each split
+    '''
+    def __init__(self, Frames, Side, Blur, Noise, Seed):
+        VirtualStack.__init__(self, Side, Side, None, None)
+        self.setBitDepth(16)
+        self.Frames = Frames
+        self.Side = Side
+        self.Blur = Blur
+        self.Noise = Noise
+        self.Seed = Seed
+        # The noise seed of ImageJ is global: frames are drawn one at a time
+        self.Lock = threading.Lock()
+        self.Last = (None, None)
+
+    def getSize(self):
+        return len(self.Frames)
+
+    def getSliceLabel(self, n):
+        return 'Frame ' + str(n)
+
+    def getProcessor(self, n):
+        self.Lock.acquire()
+        try:
+            Frame, ip = self.Last
+            if Frame != n:
+                ip = draw_frame(self.Frames[n - 1], self.Side, self.Blur, self.Noise, self.Seed*100003 + n)
+                self.Last = (n, ip)
+            return ip
+        finally:
+            self.Lock.release()
+
+def movie(nNuclei, nFrames, Radius=18, Density=0.15, Speed=3.0, Turn=0.3, Division=0.005,
+        Touching=0.1, Noise=50.0, Blur=1.5, Seed=0):
+    '''
+    Return the movie (ImagePlus, one virtual slice per frame) and its ground truth:
+    {'Frames': [[(track id, x, y, radius) of each nucleus] of each frame],
+    'Mothers': {daughter track id: (mother track id, first frame of the daughter)}}
+    Frames are numbered from 1, as slices
+    '''
+    Random = random.Random(Seed)
+    Side = field_size(nNuclei, Radius, Density)
+    Nuclei = seed_nuclei(Random, nNuclei, Side, Radius, Touching)
+    NextId = len(Nuclei)
+    Truth = {'Frames': [], 'Mothers': {}}
+    for Frame in range(1, nFrames + 1):
+        if Frame > 1:
+            Moved = {}
+            NextNuclei = []
+            for myNucleus in Nuclei:
+                if (myNucleus.Radius >= 0.95*Radius and len(Nuclei) + len(NextNuclei) < 2*nNuclei
+                        and Random.random() < Division):
+                    if myNucleus.Partner is not None:
+                        myNucleus.Partner.Partner = None
+                    Daughters = divide(myNucleus, Random, Side, NextId)
+                    NextId += len(Daughters)
+                    for Daughter in Daughters:
+                        Truth['Mothers'][Daughter.Id] = (myNucleus.Id, Frame)
+                    NextNuclei.extend(Daughters)
+                    continue
+                move(myNucleus, Random, Side, Speed, Turn, Moved)
+                myNucleus.Radius += (Radius - myNucleus.Radius)*Growth
+                NextNuclei.append(myNucleus)
+            Nuclei = NextNuclei
+        Truth['Frames'].append([(myNucleus.Id, myNucleus.x, myNucleus.y, myNucleus.Radius) for myNucleus in Nuclei])
+    Stack = SyntheticStack(Truth['Frames'], Side, Blur, Noise, Seed)
+    return ImagePlus('Synthetic nuclei', Stack), Truth
+
+def segmentation_method(Radius=18):
+    # Threshold halfway to the nuclei intensity, binary watershed for the touching nuclei
+    # Smallest particles: daughters (half area) cut by the border of the field
+    MinArea = int(math.pi*Radius**2/4)
+    Threshold = Background + Intensity/2
+    return {'Name': 'Synthetic nuclei',
+            'Method': 'Gaussian_2 Manual_' + str(Threshold) + ' FillHoles Watershed PA_' + str(MinArea) + '-Infinity_0.00-1.00'}
+
+def watershed_method(Radius=18):
+    # Marker controlled watershed (see Segment.w_segment) on the contours of the nuclei
+    # Markers: maxima of the nuclei blurred to a single peak each, well above the noise
+    return {'Name': 'Synthetic nuclei (Watershed)',
+            'Method': {'Tolerance': Intensity/10, 'DiskRadius': 2, 'InputRB': 0, 'InputSigma': 1,
+                'MarkerRB': 0, 'MarkerSigma': Radius/3.0, 'Mask': False}}
@@ -9,6 +9,8 @@ from inra.ijpb.watershed import MarkerControlledWatershedTransform2D as Watershe
 from inra.ijpb.morphology.strel import DiskStrel as Disk
 from inra.ijpb.morphology import Morphology
 
+import math
+
 def generate_gradient(ip, sigma):
     myIP = ip.duplicate()
     myBlur = GaussianBlur()
@@ -19,37 +21,71 @@ def generate_gradient(ip, sigma):
     #TODO: add mexican filter 2px to clean and sharpen the contour image
     return gradient_ip
 
-def generate_marker(markers, ip):
+def crop_margin(sigma):
+    # Pixels around a cluster that its gradient depends on:
+    # Gaussian kernel radius, then dilation and erosion by a disk of radius sigma
+    return int(math.ceil(4.2 * sigma)) + 2 * int(math.ceil(sigma)) + 2
+
+def crop(ip, x0, y0, width, height):
+    ip.setRoi(x0, y0, width, height)
+    cropped_ip = ip.crop()
+    ip.resetRoi()
+    return cropped_ip
+
+def generate_marker(markers, ip, x0=0, y0=0):
     marker_ip = ByteProcessor(ip.width, ip.height)
     for i, marker in enumerate(markers):
         # Set pixel at marker coordinate to value (i + 1)
         # Not (i) because i can be == 0 (which is the value of bg)
-        marker_ip.set(marker[0], marker[1], i + 1)
+        x, y = marker[0] - x0, marker[1] - y0
+        if 0 <= x < ip.width and 0 <= y < ip.height:
+            marker_ip.set(x, y, i + 1)
     return marker_ip
 
-def generate_mask(roi, ip):
+def generate_mask(roi, ip, x0=0, y0=0):
     mask_ip = ByteProcessor(ip.width, ip.height)
     mask_ip.setValue(255)
+    if x0 or y0:
+        Bounds = roi.getBounds()
+        roi = roi.clone()
+        roi.setLocation(Bounds.x - x0, Bounds.y - y0)
     mask_ip.fill(roi)
     return mask_ip
 
 def split(ip, markers, clusterROI, sigma, input_ip):
+    '''
+    Watershed of clusterROI from markers, on the bounding box of the cluster (plus a margin)
+    input_ip, when given, is a full-frame gradient. Otherwise the gradient of the box is computed
+    Return the ROIs (in frame coordinates) of each marker, and input_ip
+    '''
+    # Bounding box of the cluster and the margin its gradient needs
+    Bounds = clusterROI.getBounds()
+    Margin = crop_margin(sigma)
+    x0 = max(0, Bounds.x - Margin)
+    y0 = max(0, Bounds.y - Margin)
+    width = min(ip.width, Bounds.x + Bounds.width + Margin) - x0
+    height = min(ip.height, Bounds.y + Bounds.height + Margin) - y0
     # Generate necessary images
-    marker_ip = generate_marker(markers, ip)
-    mask_ip = generate_mask(clusterROI, ip)
-    if not input_ip:
-        input_ip = generate_gradient(ip, sigma)
+    if input_ip:
+        box_input_ip = crop(input_ip, x0, y0, width, height)
+    else:
+        box_input_ip = generate_gradient(crop(ip, x0, y0, width, height), sigma)
+    marker_ip = generate_marker(markers, box_input_ip, x0, y0)
+    mask_ip = generate_mask(clusterROI, box_input_ip, x0, y0)
     # Perform watershed
-    myWatershed = Watershed(input_ip, marker_ip, mask_ip, 4)
+    myWatershed = Watershed(box_input_ip, marker_ip, mask_ip, 4)
     myWatershed.setVerbose(False)
     w_ip = myWatershed.applyWithPriorityQueue()
     myWand = Wand(w_ip)
     SplitRois = []
     for marker in markers:
-        if clusterROI.contains(marker[0], marker[1]) and w_ip.get(marker[0], marker[1]) != 0:
-            myWand.autoOutline(marker[0], marker[1])
+        if clusterROI.contains(marker[0], marker[1]) and w_ip.get(marker[0] - x0, marker[1] - y0) != 0:
+            myWand.autoOutline(marker[0] - x0, marker[1] - y0)
             if len(myWand.xpoints) > 1: #If it's only a single point, ignore it
                 myRoi = PolygonRoi(myWand.xpoints, myWand.ypoints, myWand.npoints, Roi.FREEROI)
+                # Back to frame coordinates
+                RoiBounds = myRoi.getBounds()
+                myRoi.setLocation(RoiBounds.x + x0, RoiBounds.y + y0)
                 SplitRois.append(myRoi)
             else:
                 SplitRois.append(None)
@@ -234,6 +234,9 @@ def go_to_cell(imp, myCell, SG2):
     # And change color of Roi to cyan
     imp.setPosition(SG2)
     Roi = myCell.getRoiAt(SG2)
+    if Roi is None: # Blank line (gap in the track)
+        imp.deleteRoi()
+        return
     imp.setRoi(Roi)
     Roi.setColor(c.cyan)
 
@@ -6,6 +6,7 @@ from java.awt import Color as c
 
 import Tracking.Cells as Cells
 import Tracking.Results as Results
+import Tracking.Lineage as Lineage
 
 from operator import itemgetter
 
@@ -209,6 +210,9 @@ def go_to_cell(imp, myCell, SG2):
     # And change color of Roi to cyan
     imp.setPosition(SG2)
     Roi = myCell.getRoiAt(SG2)
+    if Roi is None: # Blank line (gap in the track)
+        imp.deleteRoi()
+        return
     imp.setRoi(Roi)
     Roi.setColor(c.cyan)
 
@@ -231,7 +235,7 @@ def makeListOfCells(AllCells):
             SelectedCells.append(myCell)
     return SelectedCells
 
-def plot_each_cell(myCell, xlabel, ylabel, imp, NumDict,BoolDict,ScreenConfig, CellNum, Total):
+def plot_each_cell(myCell, xlabel, ylabel, imp, NumDict,BoolDict,ScreenConfig, CellNum, Total, myLineage):
     # Get data from cell
     Xdata = getSerie(xlabel, myCell)
     Ydata = getSerie(ylabel, myCell)
@@ -276,6 +280,12 @@ def plot_each_cell(myCell, xlabel, ylabel, imp, NumDict,BoolDict,ScreenConfig, C
     else:
         go_to_cell(imp, myCell, int(Xdata[0]))
 
+    # Daughters found when tracking (D1 and D2, in that order)
+    Daughters = myLineage.daughters(myCell.name)
+    if Daughters:
+        IJ.log(myCell.name + ' divides at frame ' + str(myLineage.division_frame(myCell.name))
+                + ' into ' + ', '.join(Daughters))
+
 
     # Display plot and move it to appropiate coordinates
     myPlot.show()
@@ -357,6 +367,7 @@ def run():
     # Load data about cell of interest
     RM.runCommand(imp,"Show None")    
     myCells = Cells.load_cells(ResultsRoot, RM)
+    myLineage = Lineage.load_lineage(ResultsRoot)
 
     # Ask what to plot
     xlabel, ylabel, NucleiColor, ScreenConfig = dialog(myCells[0])
@@ -373,7 +384,7 @@ def run():
     CellNumber = len(CellList)
     while i < CellNumber:
         myCell = CellList[i]
-        ExitStatus = plot_each_cell(myCell, xlabel, ylabel, imp,NumDict,BoolDict, ScreenConfig, i+1, CellNumber)
+        ExitStatus = plot_each_cell(myCell, xlabel, ylabel, imp,NumDict,BoolDict, ScreenConfig, i+1, CellNumber, myLineage)
         if ExitStatus == 'CANCEL':
             if i > 0: i -= 1
             else: i = 0
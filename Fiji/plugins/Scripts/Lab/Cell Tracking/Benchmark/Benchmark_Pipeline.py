@@ -0,0 +1,46 @@
+#@ String (label="Label (e.g. commit)", value="") Label
+#@ String (label="Scales (nuclei x frames)", value="100x50, 500x100, 2000x50, 100x1000, 1000x100, 500x50 Watershed") ScaleList
+#@ File (label="Report (JSON lines)", style="save") ReportFile
+#@ String (label="Compare with label", value="") CompareLabel
+#@ Integer (label="Threads", value=0) nThreads
+#@ Integer (label="Seed", value=0) Seed
+
+'''
+Time segmentation and tracking on synthetic movies, at several scales.
+Runs headless, e.g.:
+ImageJ-linux64 --headless --run "Benchmark_Pipeline.py" 'Label="abc123",ScaleList="100x50",ReportFile="/tmp/bench.jsonl"'
+Each scale appends one line to the report. With CompareLabel, the time of each
+stage is then compared with the runs of that label (same scales).
+A scale is segmented by thresholding, or by the marker controlled watershed
+if followed by 'Watershed' (e.g. "500x50 Watershed").
+The default scales need about 3 GB of heap (see Benchmark.Scales).
+'''
+
+# Import FiJi modules
+from ij import IJ
+
+# Import my modules
+import Tracking.Benchmark as Benchmark
+import Tracking.Parallel as Parallel
+
+def parse_scales(ScaleList):
+    # '100x50, 500x100 Watershed' -> [(100, 50), (500, 100, 'Watershed')]
+    Scales = []
+    for Scale in ScaleList.split(','):
+        Fields = Scale.split()
+        nNuclei, nFrames = Fields[0].split('x')
+        Scales.append((int(nNuclei), int(nFrames)) + tuple(Fields[1:]))
+    return Scales
+
+def run():
+    Threads = nThreads
+    if Threads < 1:
+        Threads = Parallel.default_threads()
+    ReportPath = ReportFile.getAbsolutePath()
+    TrackParam = Benchmark.synthetic_track_param(nThreads=Threads)
+    Benchmark.run_benchmark(ReportPath, Label, parse_scales(ScaleList), TrackParam, Seed)
+    if CompareLabel:
+        Benchmark.compare_reports(ReportPath, CompareLabel, Label)
+    IJ.log("Benchmark report: " + ReportPath)
+
+run()
@@ -1,10 +1,12 @@
 from ij import IJ
 from ij.gui import GenericDialog
 from ij.plugin import FolderOpener
+from ij.plugin.filter import BackgroundSubtracter
 from ij.plugin.frame import RoiManager
 
 import Tracking.Results as Results
 import Tracking.Cells as Cells
+import Tracking.Parallel as Parallel
 
 import os
 import glob
@@ -17,29 +19,75 @@ class Measurement:
         self.Compartments = {} # Dictionary of lists {'Nucleus': ['Mean', 'Median'], 'Cytoplasm': ['Kurtosis']}
 
 class MeasurePosition:
-    def __init__(self, Pos, MeasureList, RollingBall):
+    def __init__(self, Pos, MeasureList, RollingBall, nThreads=1):
         os.chdir(Pos)
         self.Pos = Pos
         self.MeasureList = MeasureList
         self.RollingBall = RollingBall
+        self.nThreads = nThreads
         self.ResultsRoot = Results.results_root(Pos)
 
+    def measure_frames(self, Channels):
+        '''
+        Frame-major: each frame is visited once, the masks of the ROIs of each
+        compartment are made once (from label images), then measured in every channel
+        Frames are measured in parallel (each job reads its own processors from
+        the stacks), then written in the cell tables in frame order
+        Channels: [(Measurement, ImagePlus, rolling ball radius)]
+        '''
+        FrameEntries = {} # {frame: {compartment: [(cell, row index, ROI)]}}
+        Measured = set()
+        for myMeasurement, imp, RollingBall in Channels:
+            for Compartment in myMeasurement.Compartments.keys():
+                if Compartment in Measured:
+                    continue
+                Measured.add(Compartment)
+                for Frame, Entries in Cells.frame_rois(self.Cells, Compartment).items():
+                    FrameEntries.setdefault(Frame, {})[Compartment] = Entries
+        def measure(Frame):
+            Layers = {}
+            FrameStats = []
+            for myMeasurement, imp, RollingBall in Channels:
+                ip = imp.getStack().getProcessor(Frame)
+                if RollingBall:
+                    BackgroundSubtracter().rollingBallBackground(ip, RollingBall, False, False, False, True, True)
+                for Compartment, Keys in myMeasurement.Compartments.items():
+                    Entries = FrameEntries[Frame].get(Compartment)
+                    if not Entries:
+                        continue
+                    if Compartment not in Layers and Cells.sweep_keys(Keys):
+                        Layers[Compartment] = Cells.frame_labels(Entries, ip.getWidth(), ip.getHeight(), Compartment)
+                    Stats = Cells.frame_statistics(ip, Entries, Keys, Layers.get(Compartment))
+                    FrameStats.append((myMeasurement.Type, Compartment, Keys, Stats))
+            return FrameStats
+        Frames = sorted(FrameEntries.keys())
+        # Batches of frames, so only a few frames of statistics are kept at a time
+        BatchSize = 4*max(1, self.nThreads)
+        for Start in range(0, len(Frames), BatchSize):
+            Batch = Frames[Start:Start + BatchSize]
+            BatchStats = Parallel.run_tasks(measure, [(Frame,) for Frame in Batch], self.nThreads)
+            for Frame, FrameStats in zip(Batch, BatchStats):
+                for Type, Compartment, Keys, Stats in FrameStats:
+                    Cells.add_frame_measurements(FrameEntries[Frame][Compartment], Stats, Type, Keys, Compartment)
+
     def analyze(self, RM):
         self.Cells = Cells.load_cells(self.ResultsRoot, RM)
+        # Virtual stacks: each job reads its frame, and subtracts its background
+        Channels = []
+        path = None
         for myMeasurement in self.MeasureList:
             Type = myMeasurement.Type
             IJ.log("   " + Type)
             if Type != "Shape":
                 path = os.path.join(self.Pos, myMeasurement.Type)
-                imp = FolderOpener.open(path)
-                if self.RollingBall:
-                    IJ.run(imp, "Subtract Background...", "rolling=" + str(self.RollingBall) + " stack")
+                Channels.append((myMeasurement, FolderOpener.open(path, "virtual"), self.RollingBall))
             elif Type == "Shape":
-                #TODO: it won't work if only measuring shape!
-                imp = FolderOpener.open(path)
-            for Compartment, Keys in myMeasurement.Compartments.items():
-                for myCell in self.Cells:
-                    myCell.measure_channel(imp, Type, Keys, Compartment)
+                # Shape doesn't depend on the pixel values: measured on a channel, as is
+                if path is None:
+                    path = sorted(glob.glob(os.path.join(self.Pos, 'w*')))[0]
+                Channels.append((myMeasurement, FolderOpener.open(path, "virtual"), 0))
+        self.measure_frames(Channels)
+        for myMeasurement, imp, RollingBall in Channels:
             imp.close()
         Cells.save_cells(self.Cells, ResultsRoot=self.ResultsRoot, SaveData=True, Prefix='0')
 
@@ -59,6 +107,7 @@ def Dialog(ChannelNames, CompartmentList):
         for Compartment in CompartmentList:
             gd.addCheckbox(Compartment, False)
     gd.addNumericField('Rolling Ball radius:', 38, 0)
+    gd.addNumericField('Threads:', Parallel.default_threads(), 0)
     gd.showDialog()
     # Exit if canceled
     if gd.wasCanceled():
@@ -70,6 +119,7 @@ def Dialog(ChannelNames, CompartmentList):
             if gd.getNextBoolean():
                 myMeasurement.Compartments[Compartment] = []
     RollingBall = gd.getNextNumber()
+    nThreads = int(gd.getNextNumber())
 
     # For each channel, determine which parameters you want to measure
     ShapeKeys = ['Area', 'Perimeter', 'Centroid', 'Circularity', 'Feret']
@@ -103,7 +153,7 @@ def Dialog(ChannelNames, CompartmentList):
                     for Key in ChannelKeys:
                         if gd.getNextBoolean():
                             myMeasurement.Compartments[Compartment].append(Key)
-    return trueMeasureList, RollingBall
+    return trueMeasureList, RollingBall, nThreads
 
 def run():
     DataFolder = IJ.getDir('')
@@ -143,13 +193,13 @@ def run():
     if FullRoi: CompartmentList.append('Full Cell')
 
     # Dialog box to ask for a few parameters
-    MeasureList, RollingBall = Dialog(ChannelNames, CompartmentList)
+    MeasureList, RollingBall, nThreads = Dialog(ChannelNames, CompartmentList)
 
     RM.reset()
     IJ.log("Measuring...")
     for Pos in PosNames:
         IJ.log("  Position " + Pos)
-        Measure = MeasurePosition(os.path.join(DataFolder, Pos), MeasureList, RollingBall)
+        Measure = MeasurePosition(os.path.join(DataFolder, Pos), MeasureList, RollingBall, nThreads)
         Measure.analyze(RM)
         RM.reset()
     IJ.log("Done.")
@@ -18,6 +18,10 @@ import Tracking.Results as Results
 
 # Import my tracking algorithms
 import Tracking.NucleiTracking as NucleiTracking
+import Tracking.Parallel as Parallel
+import Tracking.Drift as Drift
+import Tracking.Lineage as Lineage
+import Tracking.Metrics as Metrics
 
 ## GLOBAL SETTINGS ##
 def dialog(DataFolder, ChannelNames, minPos, maxPos):
@@ -40,10 +44,29 @@ def dialog(DataFolder, ChannelNames, minPos, maxPos):
     Inputs = [
             "External gradient"
             ]
+    LinkingEngines = [
+            "Gale-Shapley",
+            "Global assignment"
+            ]
+    OverlapEngines = [
+            "ROI geometry",
+            "Label image"
+            ]
+    MotionModels = [
+            "None",
+            "Kalman"
+            ]
     gd.addSlider('Max Distance:', 50, 150, 100)
     gd.addSlider('Watershed Sigma:', 2, 10, 5)
     gd.addChoice('Watershed input:', Inputs, Inputs[0])
     gd.addCheckbox('Backup matching using distance', True)
+    gd.addCheckbox('Compensate stage drift', False)
+    gd.addChoice('Overlap engine:', OverlapEngines, OverlapEngines[0])
+    gd.addChoice('Linking:', LinkingEngines, LinkingEngines[0])
+    gd.addChoice('Motion model:', MotionModels, MotionModels[0])
+    gd.addNumericField('Close gaps up to (frames):', 0, 0)
+    gd.addNumericField('Gap distance:', 100, 0)
+    gd.addNumericField('Threads:', Parallel.default_threads(), 0)
 
     ## Position settings ##
     gd.addMessage('Positions to process:')
@@ -63,9 +86,18 @@ def dialog(DataFolder, ChannelNames, minPos, maxPos):
     w_sigma = int(gd.getNextNumber())
     w_input = gd.getNextChoice()
     BackupDistance = gd.getNextBoolean()
+    DriftCorrection = gd.getNextBoolean()
+    OverlapEngine = gd.getNextChoice()
+    Linking = gd.getNextChoice()
+    MotionModel = gd.getNextChoice()
+    GapFrames = int(gd.getNextNumber())
+    GapDistance = gd.getNextNumber()
+    nThreads = int(gd.getNextNumber())
     firstPos = gd.getNextNumber()
     lastPos = gd.getNextNumber()
-    myTracking = {'Max Distance':maxDistance, 'Watershed sigma':w_sigma, 'Watershed input':w_input, 'BackupDistance':BackupDistance}
+    myTracking = {'Max Distance':maxDistance, 'Watershed sigma':w_sigma, 'Watershed input':w_input, 'BackupDistance':BackupDistance,
+            'Overlap engine':OverlapEngine, 'Linking':Linking, 'Motion model':MotionModel, 'Threads':nThreads,
+            'Drift correction':DriftCorrection, 'Gap frames':GapFrames, 'Gap distance':GapDistance}
     return myChannel, myThresholding, myTracking, firstPos, lastPos
 
 ###############################################
@@ -76,18 +108,33 @@ def process_position(RM, impPath, SegParam, TrackParam, PosValue):
     imp = FolderOpener.open(impPath)
     ImgRoot = Results.get_rootpath(impPath)
     ResultsRoot = Results.results_root(ImgRoot)
+    Metrics.start(PosValue)
 
     # Threshold
     IJ.log(" > Fetching ROIs from each frame...")
-    RoiPerFrames = Segment.segment(imp, SegParam, RM)
+    RoiPerFrames, StatsPerFrames = Segment.segment(imp, SegParam, nThreads=TrackParam['Threads'])
+
+    # Stage drift between frames, compensated when testing overlaps
+    Drifts = None
+    if TrackParam['Drift correction']:
+        IJ.log(" > Estimating stage drift...")
+        Start = Metrics.clock()
+        Drifts = Drift.frame_drifts(imp, TrackParam['Threads'])
+        Metrics.stage('Drift', Start)
+        Drift.save_drifts(Drifts, ResultsRoot)
 
     # Perform the actual tracking
     IJ.log(" > Matching Roi frame to frame...")
-    myCells = NucleiTracking.track(RoiPerFrames, TrackParam, imp, PosValue)
+    myCells = NucleiTracking.track(RoiPerFrames, TrackParam, imp, PosValue, StatsPerFrames, Drifts)
 
     ## Save rois and write table
     IJ.log(" > Saving cells...")
     Cells.save_cells(myCells, ResultsRoot=ResultsRoot, rm=RM, SaveRois=True, SaveData=True, Prefix='0', Type='Nuclei')
+    Lineage.save_lineage(myCells, ResultsRoot, Prefix='0')
+
+    # Time and memory of each stage, and counts per frame
+    Report = Metrics.save(ResultsRoot, Prefix='0')
+    IJ.log(" > " + Metrics.summary(Report))
 
 def run():
     DataFolder = IJ.getDir('')